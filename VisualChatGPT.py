@@ -9,21 +9,25 @@ from tkinter.scrolledtext import *
 from tkinter.filedialog import *
 from tkinter.ttk import *
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+import queue
 import sys
+import threading
 
-from PIL import Image
-from PIL.ImageTk import PhotoImage
-import requests
-import tiktoken
 import _jsonnet
 
+from llmerick import Budget, Cache, Client, Metrics, TokenIndex, add_budget_arguments, add_cache_arguments, add_daemon_arguments, add_metrics_arguments, budget_from_args, cache_from_args, count_tokens, daemon_from_args, metrics_from_args, price
+
 
 ROOT = Path(__file__).resolve().parent
 MODEL = 'gpt-3.5-turbo'
-OPENAI_API_KEY = (Path.home() / '.openai_api_key').read_text().strip()
-PRICING = 0.002 / 1000  # dollars/token
+LOG_INTERVAL = 100  # milliseconds
+LOG_MAX_LINES = 5000
+CONCURRENCY = 8
+POLL_INTERVAL = 50  # milliseconds
+SYNC_DELAY = 500  # milliseconds
 
 
 def _configure_text_defaults(text: Text):
@@ -39,6 +43,41 @@ def _configure_text_defaults(text: Text):
     text.bind('<Tab>', callback)
 
 
+def _sync_text(text: Text, callback: Callable[[str], None]) -> Callable[[], None]:
+    """Hand the contents of `text` to `callback` after edits, lazily.
+
+    Copying a large document out of the widget on every keystroke makes
+    typing lag, so edits only set a dirty flag. The text is copied once
+    typing pauses for SYNC_DELAY milliseconds, or when the returned
+    function is called, e.g. right before compiling.
+    """
+    dirty = False
+    after_id = None
+
+    def sync():
+        nonlocal dirty, after_id
+        if after_id is not None:
+            text.after_cancel(after_id)
+            after_id = None
+        if dirty:
+            dirty = False
+            callback(text.get('1.0', 'end-1c'))
+
+    def on_modified(event):
+        nonlocal dirty, after_id
+        # Clearing the flag below fires <<Modified>> again.
+        if not text.edit_modified():
+            return
+        text.edit_modified(0)
+        dirty = True
+        if after_id is not None:
+            text.after_cancel(after_id)
+        after_id = text.after(SYNC_DELAY, sync)
+    text.bind('<<Modified>>', on_modified)
+
+    return sync
+
+
 @dataclass
 class Message:
     role: str
@@ -52,35 +91,135 @@ class Message:
         )
 
     def tk(self, master: Widget) -> Widget:
-        frame = Frame(master)
-        frame.grid_rowconfigure(0, weight=0)
-        frame.grid_rowconfigure(1, weight=1)
-        frame.grid_columnconfigure(0, weight=1)
+        editor = MessageEditor(master)
+        editor.bind(self)
+        return editor.frame
 
-        role_var = StringVar()
-        role_var.set(self.role)
-        def callback(name, index, mode):
-            self.role = role_var.get()
-        role_var.trace('w', callback)
 
-        content_var = StringVar()
-        content_var.set(self.content)
+class MessageEditor(object):
+    """Role entry and content box that edit whichever message they are bound to."""
+
+    def __init__(self, master: Widget):
+        self.message = None
+
+        self.frame = Frame(master)
+        self.frame.grid_rowconfigure(0, weight=0)
+        self.frame.grid_rowconfigure(1, weight=1)
+        self.frame.grid_columnconfigure(0, weight=1)
+
+        self.role_var = StringVar()
         def callback(name, index, mode):
-            self.content = content_var.get()
-        content_var.trace('w', callback)
+            if self.message is not None:
+                self.message.role = self.role_var.get()
+        self.role_var.trace('w', callback)
 
-        role_entry = Entry(frame, textvariable=role_var)
+        role_entry = Entry(self.frame, textvariable=self.role_var)
         role_entry.grid(row=0, column=0, sticky='nsew')
 
-        content_text = ScrolledText(frame)
-        _configure_text_defaults(content_text)
-        content_text.insert(END, content_var.get())
+        self.text = ScrolledText(self.frame)
+        _configure_text_defaults(self.text)
+        def callback(content):
+            if self.message is not None:
+                self.message.content = content
+        self.sync = _sync_text(self.text, callback)
+        self.text.grid(row=1, column=0, sticky='nsew')
+
+    def bind(self, message: Optional[Message]):
+        self.sync()
+        self.message = None
+        self.role_var.set('' if message is None else message.role)
+        self.text.delete('1.0', END)
+        self.text.insert(END, '' if message is None else message.content)
+        self.text.edit_modified(0)
+        self.message = message
+
+
+class Pager(object):
+    """List of items beside a page that shows the selected one.
+
+    Only the selected item is put into widgets, using a pool of
+    MessageEditors that are rebound as the selection changes, so showing a
+    thousand requests costs the same as showing one.
+    """
+
+    def __init__(self, master: Widget):
+        self.items = []
+        self.selected = None
+        self.editors = []
+
+        self.frame = Frame(master)
+        self.frame.grid_rowconfigure(0, weight=1)
+        self.frame.grid_columnconfigure(2, weight=1)
+
+        self.listbox = Listbox(self.frame, exportselection=False, width=16)
+        self.listbox.grid(row=0, column=0, sticky='ns')
         def callback(event):
-            content_var.set(content_text.get('1.0', END))
-        content_text.bind('<<Modified>>', callback)
-        content_text.grid(row=1, column=0, sticky='nsew')
-
-        return frame
+            selection = self.listbox.curselection()
+            if selection:
+                self.select(selection[0])
+        self.listbox.bind('<<ListboxSelect>>', callback)
+
+        scrollbar = Scrollbar(self.frame, orient=VERTICAL, command=self.listbox.yview)
+        scrollbar.grid(row=0, column=1, sticky='ns')
+        self.listbox.configure(yscrollcommand=scrollbar.set)
+
+        self.page = Frame(self.frame)
+        self.page.grid(row=0, column=2, sticky='nsew')
+        self.page.grid_columnconfigure(0, weight=1)
+
+    def extend(self, items: List[Tuple[str, List[Message]]]):
+        if not items:
+            return
+
+        self.items.extend(messages for _, messages in items)
+        self.listbox.insert(END, *(label for label, _ in items))
+
+        if self.selected is None:
+            self.select(0)
+
+    def sync(self):
+        for editor in self.editors:
+            editor.sync()
+
+    def update(self, i: int, *, label: Optional[str] = None, messages: Optional[List[Message]] = None):
+        if label is not None:
+            self.listbox.delete(i)
+            self.listbox.insert(i, label)
+            if i == self.selected:
+                self.listbox.selection_set(i)
+
+        if messages is not None:
+            self.items[i] = messages
+            if i == self.selected:
+                self.select(i)
+
+    def append(self, i: int, text: str):
+        """Add streamed text to the last message of item `i`."""
+        if i == self.selected:
+            editor = self.editors[len(self.items[i]) - 1]
+            editor.text.insert(END, text)
+            editor.text.see(END)
+        self.items[i][-1].content += text
+
+    def select(self, i: int):
+        self.selected = i
+        self.listbox.selection_clear(0, END)
+        self.listbox.selection_set(i)
+        self.listbox.see(i)
+
+        messages = self.items[i]
+        while len(self.editors) < len(messages):
+            self.editors.append(MessageEditor(self.page))
+
+        for j, editor in enumerate(self.editors):
+            if j < len(messages):
+                editor.bind(messages[j])
+                editor.frame.grid(row=j, column=0, sticky='nsew')
+                self.page.grid_rowconfigure(j, weight=1)
+            else:
+                editor.bind(None)
+                editor.frame.grid_remove()
+                self.page.grid_rowconfigure(j, weight=0)
 
 
 @dataclass
@@ -103,6 +242,7 @@ class Request:
 @dataclass
 class Editor:
     value: str
+    _sync: Callable[[], None] = field(default=lambda: None, init=False, repr=False, compare=False)
 
     @classmethod
     def from_path(cls, path: Path) -> Code:
@@ -111,20 +251,18 @@ class Editor:
             value=path.read_text(),
         )
 
-    def tk(self, master: Widget) -> Widget:
-        var = StringVar()
-        var.set(self.value)
-        def callback(name, index, mode):
-            self.value = var.get()
-        var.trace('w', callback)
+    def sync(self):
+        """Pull any pending edits from the widget made by tk()."""
+        self._sync()
 
+    def tk(self, master: Widget) -> Widget:
         text = ScrolledText(master)
         _configure_text_defaults(text)
-        text.insert(END, var.get())
-        def callback(event):
-            var.set(text.get('1.0', END))
-            text.edit_modified(0)
-        text.bind('<<Modified>>', callback)
+        text.insert(END, self.value)
+        text.edit_modified(0)
+        def callback(value):
+            self.value = value
+        self._sync = _sync_text(text, callback)
 
         return text
 
@@ -132,36 +270,40 @@ class Editor:
 @dataclass
 class Requests:
     requests: List[Request]
+    _sync: Callable[[], None] = field(default=lambda: None, init=False, repr=False, compare=False)
     
     def report(self):
-        encoding = tiktoken.encoding_for_model(MODEL)
-        encode = encoding.encode_ordinary
-        decode = encoding.decode
+        message_prompt_tokens = iter(count_tokens([
+            message.content
+            for request in self.requests
+            for message in request.messages
+        ], model=MODEL))
         
         total_prompt_tokens = 0
         for i, request in enumerate(self.requests):
             request_prompt_tokens = 0
             for message in request.messages:
-                message_prompt_tokens = len(encode(message.content))
-                
-                request_prompt_tokens += message_prompt_tokens
+                request_prompt_tokens += next(message_prompt_tokens)
             
-            print(f'Request {i}: prompt_tokens = {request_prompt_tokens!r}; cost = ${request_prompt_tokens * PRICING:0.3f}')
+            print(f'Request {i}: prompt_tokens = {request_prompt_tokens!r}; cost = ${price(MODEL, prompt_tokens=request_prompt_tokens):0.3f}')
             
             total_prompt_tokens += request_prompt_tokens
 
-        print(f'Requests: prompt_tokens = {total_prompt_tokens!r}; cost = ${total_prompt_tokens * PRICING:0.2f}')
+        print(f'Requests: prompt_tokens = {total_prompt_tokens!r}; cost = ${price(MODEL, prompt_tokens=total_prompt_tokens):0.2f}')
 
-    def tk(self, master: Widget) -> Widget:
-        notebook = Notebook(master)
-        notebook.pack(fill='both', expand=True)
+    def sync(self):
+        """Pull any pending edits from the widget made by tk()."""
+        self._sync()
 
-        for i, request in enumerate(self.requests):
-            request = request.tk(notebook)
-            request.pack(fill='both', expand=True)
-            notebook.add(request, text=f'Request {i}')
+    def tk(self, master: Widget) -> Widget:
+        pager = Pager(master)
+        pager.extend([
+            (f'Request {i}', request.messages)
+            for i, request in enumerate(self.requests)
+        ])
+        self._sync = pager.sync
 
-        return notebook
+        return pager.frame
 
 
 @dataclass
@@ -170,6 +312,7 @@ class Response:
     usage_completion_tokens: int
     usage_total_tokens: int
     message: Message
+    error: Optional[str] = None
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> Response:
@@ -179,6 +322,26 @@ class Response:
             usage_total_tokens=data['usage']['total_tokens'],
             message=Message.from_dict(data['choices'][0]['message'])
         )
+
+    @classmethod
+    def failed(cls, error: str) -> Response:
+        # Stands in for a response that never arrived, so that Response i
+        # still lines up with Request i.
+        return cls(
+            usage_prompt_tokens=0,
+            usage_completion_tokens=0,
+            usage_total_tokens=0,
+            message=Message(role='assistant', content=''),
+            error=error,
+        )
+
+    @property
+    def label(self) -> str:
+        return '' if self.error is None else f' ({self.error})'
+
+    @property
+    def cost(self) -> float:
+        return price(MODEL, prompt_tokens=self.usage_prompt_tokens, completion_tokens=self.usage_completion_tokens)
     
     def tk(self, master: Widget) -> Widget:
         return self.message.tk(master)
@@ -190,14 +353,16 @@ class Responses:
     
     def report(self):
         total_response_tokens = 0
+        total_response_cost = 0
         for i, response in enumerate(self.responses):
             response_tokens = response.usage_total_tokens
             
-            print(f'Response {i}: tokens = {response_tokens!r}; cost = ${PRICING * response_tokens:0.3f}')
+            print(f'Response {i}{response.label}: tokens = {response_tokens!r}; cost = ${response.cost:0.3f}')
             
             total_response_tokens += response_tokens
+            total_response_cost += response.cost
 
-        print(f'Responses: tokens = {total_response_tokens!r}; cost = ${PRICING * total_response_tokens:0.2f}')
+        print(f'Responses: tokens = {total_response_tokens!r}; cost = ${total_response_cost:0.2f}')
 
     def tk(self, master: Widget) -> Widget:
         frame = Frame(master)
@@ -216,10 +381,13 @@ class Responses:
         })).tk(frame)
         editor.grid(row=0, column=0, sticky='nsew')
 
-        for i, response in enumerate(self.responses, start=1):
-            response = response.tk(frame)
-            response.grid(row=i, column=0, sticky='nsew')
-            frame.grid_rowconfigure(i, weight=2)
+        pager = Pager(frame)
+        pager.extend([
+            (f'Response {i}{response.label}', [response.message])
+            for i, response in enumerate(self.responses)
+        ])
+        pager.frame.grid(row=1, column=0, sticky='nsew')
+        frame.grid_rowconfigure(1, weight=2)
 
         return frame
 
@@ -234,19 +402,17 @@ class Split:
         # Let's coerce them to integers.
         self.new_tokens = int(self.new_tokens)
         self.old_tokens = int(self.old_tokens)
+        if self.new_tokens < 1:
+            raise ValueError(f'new_tokens must be at least 1, not {self.new_tokens!r}')
 
     def __call__(self, document: str) -> List[str]:
-        encoding = tiktoken.encoding_for_model(MODEL)
-        encode = encoding.encode_ordinary
-        decode = encoding.decode
+        index = TokenIndex.from_document(document, model=MODEL)
 
         fragments = []
 
-        tokens = encode(document)
         i = 0
-        while i < len(tokens):
-            chunk = tokens[i:i+self.new_tokens+self.old_tokens+1]
-            fragment = decode(chunk)
+        while i < len(index):
+            fragment = index.text(i, min(len(index), i+self.new_tokens+self.old_tokens+1))
             fragments.append(fragment)
             
             i += self.new_tokens
@@ -258,6 +424,7 @@ class Split:
 class Code:
     name: str
     source: str
+    _sync: Callable[[], None] = field(default=lambda: None, init=False, repr=False, compare=False)
 
     @classmethod
     def from_path(cls, path: Path) -> Code:
@@ -267,20 +434,18 @@ class Code:
             source=path.read_text(),
         )
 
-    def tk(self, master: Widget) -> Widget:
-        var = StringVar()
-        var.set(self.source)
-        def callback(name, index, mode):
-            self.source = var.get()
-        var.trace('w', callback)
+    def sync(self):
+        """Pull any pending edits from the widget made by tk()."""
+        self._sync()
 
+    def tk(self, master: Widget) -> Widget:
         text = ScrolledText(master)
         _configure_text_defaults(text)
-        text.insert(END, var.get())
-        def callback(event):
-            var.set(text.get('1.0', END))
-            text.edit_modified(0)
-        text.bind('<<Modified>>', callback)
+        text.insert(END, self.source)
+        text.edit_modified(0)
+        def callback(source):
+            self.source = source
+        self._sync = _sync_text(text, callback)
 
         return text
 
@@ -289,6 +454,7 @@ class Code:
 class Document:
     name: str
     text: str
+    _sync: Callable[[], None] = field(default=lambda: None, init=False, repr=False, compare=False)
 
     @classmethod
     def from_path(cls, path: Path) -> Document:
@@ -301,48 +467,70 @@ class Document:
     def report(self):
         print(f'Document(name={self.name!r}, len(text)={len(self.text)!r})')
 
-    def tk(self, master: Widget) -> Widget:
-        var = StringVar()
-        var.set(self.text)
-        def callback(name, index, mode):
-            self.text = var.get()
-        var.trace('w', callback)
+    def sync(self):
+        """Pull any pending edits from the widget made by tk()."""
+        self._sync()
 
+    def tk(self, master: Widget) -> Widget:
         text = ScrolledText(master)
         _configure_text_defaults(text)
-        text.insert(END, var.get())
-        def callback(event):
-            var.set(text.get('1.0', END))
-            text.edit_modified(0)
-        text.bind('<<Modified>>', callback)
+        text.insert(END, self.text)
+        text.edit_modified(0)
+        def callback(text):
+            self.text = text
+        self._sync = _sync_text(text, callback)
 
         return text
 
 
 class TextRedirector(object):
+    """File-like sink that mirrors writes into a Text widget.
+
+    Writes may come from any thread. They are queued and flushed into the
+    widget from the Tk main loop every LOG_INTERVAL milliseconds, one insert
+    per batch, and the widget is trimmed to its last LOG_MAX_LINES lines.
+    """
+
     def __init__(self, fileobj, widget, tag="stdout"):
         self.fileobj = fileobj
         self.widget = widget
         self.tag = tag
+        self._pending = []
+        self._lock = threading.Lock()
+        self.widget.after(LOG_INTERVAL, self._drain)
 
     def write(self, str):
-        self.widget.configure(state="normal")
-        self.widget.insert("end", str, (self.tag,))
-        self.widget.see('end')
-        self.widget.configure(state="disabled")
+        with self._lock:
+            self._pending.append(str)
         self.fileobj.write(str)
     
     def flush(self):
         self.fileobj.flush()
 
+    def _drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        if pending:
+            self.widget.configure(state="normal")
+            self.widget.insert("end", "".join(pending), (self.tag,))
+            lines = int(self.widget.index("end-1c").split(".")[0])
+            if lines > LOG_MAX_LINES:
+                self.widget.delete("1.0", f"{lines - LOG_MAX_LINES + 1}.0")
+            self.widget.see('end')
+            self.widget.configure(state="disabled")
+
+        self.widget.after(LOG_INTERVAL, self._drain)
+
 
 @dataclass
 class Application:
-    url: str
+    client: Client
     document: Document
     code: Code
     requests: Requests
     responses: Responses
+    truncate: bool = False
 
     def compile(self):
         data = json.loads(_jsonnet.evaluate_snippet(
@@ -369,40 +557,93 @@ class Application:
         ]
         
         self.requests.report()
+        if self.client.budget is not None:
+            self.client.budget.report(data['requests'], model=self.client.model)
     
-    def execute(self):
-        responses = []
-        for i, request in enumerate(self.requests.requests):
-            with requests.post(
-                url=self.url,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {OPENAI_API_KEY}',
-                },
-                json={
-                    'model': MODEL,
-                    'messages': [
-                        {
-                            'role': message.role,
-                            'content': message.content,
-                        }
-                        for message in request.messages
-                    ],
-                },
-            ) as r:
-                response = r.json()
-            
-            response = Response.from_dict(response)
-            responses.append(response)
-        
-        self.responses.responses = responses
-        self.responses.report()
+    def execute(
+        self,
+        *,
+        on_response: Optional[Callable[[int, Response], None]] = None,
+        on_delta: Optional[Callable[[int, str], None]] = None,
+        cancel: Optional[threading.Event] = None,
+    ):
+        """Send every request, up to `client.concurrency` at a time.
+
+        This blocks, so the GUI calls it from a worker thread. Each response
+        is handed to `on_response` as soon as it arrives, in completion
+        order; when streaming, each piece of it is first handed to
+        `on_delta`. Setting `cancel` stops any requests that have not
+        started.
+
+        A request that fails, or is cancelled, gets a Response.failed() in
+        its place, so `responses` stays aligned with `requests` and keeps
+        every response that did arrive.
+
+        Before anything is sent, the requests are checked against the
+        client's budget; if they do not all fit, this either raises
+        BudgetExceeded or, with `truncate`, sends only those that do.
+        """
+        requests = [
+            {
+                'messages': [
+                    {
+                        'role': message.role,
+                        'content': message.content,
+                    }
+                    for message in request.messages
+                ],
+            }
+            for request in self.requests.requests
+        ]
+
+        # With `truncate`, only a prefix is sent; the rest are "not sent".
+        responses = [None] * len(requests)
+        requests = self.client.preflight(requests, truncate=self.truncate)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, self.client.concurrency))
+        try:
+            def fetch(i, request):
+                def callback(delta):
+                    if on_delta is not None:
+                        on_delta(i, delta)
+                return self.client.fetch(request, on_delta=callback)
+
+            futures = {
+                executor.submit(fetch, i, request): i
+                for i, request in enumerate(requests)
+            }
+
+            for future in as_completed(futures):
+                if cancel is not None and cancel.is_set():
+                    break
+
+                i = futures[future]
+                try:
+                    response = Response.from_dict(future.result())
+                except Exception as e:
+                    print(f'Response {i}: {e!r}', file=sys.stderr)
+                    response = Response.failed(type(e).__name__)
+                responses[i] = response
+
+                if on_response is not None:
+                    on_response(i, response)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+            self.responses.responses = [
+                response if response is not None else Response.failed('cancelled' if i < len(requests) else 'not sent')
+                for i, response in enumerate(responses)
+            ]
 
     def tk(self, master: Widget) -> Widget:
         menu = Menu(master)
         def callback():
             nonlocal document
             
+            # Settle any pending edits now so they cannot land on top of the
+            # newly opened document.
+            self.document.sync()
+
             if document is not None:
                 notebook.forget(document)
                 document = None
@@ -431,6 +672,8 @@ class Application:
         def callback():
             nonlocal code
 
+            self.code.sync()
+
             old_code = code
             
             try:
@@ -459,6 +702,10 @@ class Application:
         def callback():
             nonlocal requests, responses
 
+            if execution is not None:
+                print('Compile: requests are still executing; cancel them first', file=sys.stderr)
+                return
+
             if requests is not None:
                 notebook.forget(requests)
                 requests = None
@@ -467,6 +714,9 @@ class Application:
                 notebook.forget(responses)
                 responses = None
 
+            self.code.sync()
+            self.document.sync()
+
             try:
                 self.compile()
             finally:
@@ -475,17 +725,99 @@ class Application:
                 notebook.select(2)
         menu.add_command(label='Compile Code', command=callback)
         def callback():
-            nonlocal responses
+            nonlocal responses, execution
+
+            if execution is not None:
+                return
+
+            self.requests.sync()
+
             if responses is not None:
                 notebook.forget(responses)
                 responses = None
 
-            try:
-                self.execute()
-            finally:
-                responses = self.responses.tk(notebook)
-                notebook.add(responses, text='4 Responses', underline=0)
-                notebook.select(3)
+            # Until the run finishes, every request gets a placeholder entry
+            # that fills in as its response streams or arrives.
+            self.responses.responses = []
+            pager = Pager(notebook)
+            pager.extend([
+                (f'Response {i} ...', [Message(role='assistant', content='')])
+                for i in range(len(self.requests.requests))
+            ])
+            responses = pager.frame
+            notebook.add(responses, text='4 Responses', underline=0)
+            notebook.select(3)
+
+            # The requests run on a worker thread; their results come back
+            # through a queue that the Tk main loop polls, because Tk widgets
+            # may only be touched from the main thread.
+            execution = \
+            cancel = threading.Event()
+            results = queue.Queue()
+
+            def worker():
+                try:
+                    self.execute(
+                        on_response=lambda i, response: results.put((i, response)),
+                        on_delta=lambda i, delta: results.put((i, delta)),
+                        cancel=cancel,
+                    )
+                except Exception as e:
+                    results.put((None, e))
+                else:
+                    results.put((None, None))
+            threading.Thread(target=worker, daemon=True).start()
+
+            total = len(self.requests.requests)
+            done = 0
+            failed = 0
+            tokens = 0
+            cost = 0
+            progress.configure(maximum=max(1, total), value=0)
+            status.set(f'Executing {total} requests')
+            cancel_button.state(['!disabled'])
+
+            def poll():
+                nonlocal responses, execution, done, failed, tokens, cost
+
+                while True:
+                    try:
+                        i, response = results.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    if i is None:
+                        if response is not None:
+                            print(f'Execute: {response!r}', file=sys.stderr)
+
+                        execution = None
+                        cancel_button.state(['disabled'])
+                        status.set(f'{"Cancelled" if cancel.is_set() else "Done"}: {done}/{total} responses ({failed} failed); tokens = {tokens!r}; cost = ${cost:0.3f}')
+
+                        self.responses.report()
+                        self.client.report()
+
+                        notebook.forget(responses)
+                        responses = self.responses.tk(notebook)
+                        notebook.add(responses, text='4 Responses', underline=0)
+                        notebook.select(3)
+                        return
+
+                    if isinstance(response, str):
+                        pager.append(i, response)
+                        continue
+
+                    done += 1
+                    failed += response.error is not None
+                    tokens += response.usage_total_tokens
+                    cost += response.cost
+                    progress.configure(value=done)
+                    status.set(f'{done}/{total} responses; tokens = {tokens!r}; cost = ${cost:0.3f}')
+
+                    pager.update(i, label=f'Response {i}{response.label}', messages=[response.message])
+
+                master.after(POLL_INTERVAL, poll)
+            master.after(POLL_INTERVAL, poll)
         menu.add_command(label='Execute Requests', command=callback)
         master.config(menu=menu)
         
@@ -493,8 +825,27 @@ class Application:
         frame.grid(row=0, column=0, sticky='nsew')
         frame.grid_rowconfigure(0, weight=1)
         frame.grid_rowconfigure(1, weight=0)
+        frame.grid_rowconfigure(2, weight=0)
         frame.grid_columnconfigure(0, weight=1)
 
+        statusbar = Frame(frame)
+        statusbar.grid(row=2, column=0, sticky='sew')
+        statusbar.grid_columnconfigure(1, weight=1)
+
+        progress = Progressbar(statusbar, mode='determinate', length=200)
+        progress.grid(row=0, column=0, sticky='w')
+
+        status = StringVar()
+        Label(statusbar, textvariable=status).grid(row=0, column=1, sticky='ew')
+
+        def callback():
+            if execution is not None:
+                execution.set()
+                status.set('Cancelling...')
+        cancel_button = Button(statusbar, text='Cancel', command=callback)
+        cancel_button.grid(row=0, column=2, sticky='e')
+        cancel_button.state(['disabled'])
+
         text = ScrolledText(frame, height=8)
         _configure_text_defaults(text)
         text.tag_configure('stderr', foreground='#b22222')
@@ -518,12 +869,14 @@ class Application:
 
         responses = None
 
+        execution = None
+
         notebook.enable_traversal()
 
         return frame
 
 
-def main(name: str, url: str, document: Path, code: Path, icon: Path):
+def main(name: str, url: str, document: Path, code: Path, icon: Path, concurrency: int, stream: bool, cache: Optional[Cache], metrics: Metrics, budget: Optional[Budget], truncate: bool, daemon: Optional[Path]):
     tk = Tk()
     tk.geometry('640x480')
     tk.attributes('-zoomed', True)
@@ -531,6 +884,10 @@ def main(name: str, url: str, document: Path, code: Path, icon: Path):
     tk.grid_rowconfigure(0, weight=1)
     tk.grid_columnconfigure(0, weight=1)
 
+    # PIL takes a while to import and is only needed for the icon.
+    from PIL import Image
+    from PIL.ImageTk import PhotoImage
+
     icon = Image.open(icon)
     icon = PhotoImage(icon)
     tk.wm_iconphoto(True, icon)
@@ -539,7 +896,16 @@ def main(name: str, url: str, document: Path, code: Path, icon: Path):
     style.configure('stacked.TNotebook', tabposition='nw', tabplacement='nw')
 
     application = Application(
-        url=url,
+        client=Client(
+            url=url,
+            model=MODEL,
+            concurrency=concurrency,
+            cache=cache,
+            stream=stream,
+            metrics=metrics,
+            budget=budget,
+            daemon=daemon,
+        ),
         document=Document.from_path(document),
         code=Code.from_path(code),
         requests=Requests(
@@ -548,6 +914,7 @@ def main(name: str, url: str, document: Path, code: Path, icon: Path):
         responses=Responses(
             responses=[],
         ),
+        truncate=truncate,
     ).tk(tk)
 
     tk.mainloop()
@@ -570,9 +937,16 @@ def cli():
     parser.add_argument('--document', type=Path, default=Path('/dev/null'))
     parser.add_argument('--code', type=Path, default=Path('/dev/null'))
     parser.add_argument('--icon', type=icon, default=icon('C'))
+    parser.add_argument('--concurrency', '-j', type=int, default=CONCURRENCY)
+    parser.add_argument('--stream', action='store_true', help='show responses as they are generated')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_budget_arguments(parser)
+    parser.add_argument('--truncate', action='store_true', help='when over budget, send the requests that fit instead of none')
+    add_daemon_arguments(parser)
     args = vars(parser.parse_args())
 
-    main(**args)
+    main(cache=cache_from_args(args), metrics=metrics_from_args(args), budget=budget_from_args(args), daemon=daemon_from_args(args), **args)
 
 
 if __name__ == '__main__':
@@ -12,9 +12,8 @@ from pathlib import Path
 from dataclasses import dataclass
 import json
 import sys
+import threading
 
-from PIL import Image
-from PIL.ImageTk import PhotoImage
 import requests
 import tiktoken
 import _jsonnet
@@ -25,6 +24,8 @@ URL = 'https://api.openai.com/v1/chat/completions'
 MODEL = 'gpt-3.5-turbo'
 OPENAI_API_KEY = (Path.home() / '.openai_api_key').read_text().strip()
 PRICING = 0.002 / 1000  # dollars/token
+LOG_INTERVAL = 100  # milliseconds
+LOG_MAX_LINES = 5000
 
 
 def run(func):
@@ -316,21 +317,44 @@ class Editors(Frame):
 
 
 class TextRedirector(object):
+    """File-like sink that mirrors writes into a Text widget.
+
+    Writes may come from any thread. They are queued and flushed into the
+    widget from the Tk main loop every LOG_INTERVAL milliseconds, one insert
+    per batch, and the widget is trimmed to its last LOG_MAX_LINES lines.
+    """
+
     def __init__(self, fileobj, widget, tag="stdout"):
         self.fileobj = fileobj
         self.widget = widget
         self.tag = tag
+        self._pending = []
+        self._lock = threading.Lock()
+        self.widget.after(LOG_INTERVAL, self._drain)
 
     def write(self, str):
-        self.widget.configure(state="normal")
-        self.widget.insert("end", str, (self.tag,))
-        self.widget.see('end')
-        self.widget.configure(state="disabled")
+        with self._lock:
+            self._pending.append(str)
         self.fileobj.write(str)
     
     def flush(self):
         self.fileobj.flush()
 
+    def _drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        if pending:
+            self.widget.configure(state="normal")
+            self.widget.insert("end", "".join(pending), (self.tag,))
+            lines = int(self.widget.index("end-1c").split(".")[0])
+            if lines > LOG_MAX_LINES:
+                self.widget.delete("1.0", f"{lines - LOG_MAX_LINES + 1}.0")
+            self.widget.see('end')
+            self.widget.configure(state="disabled")
+
+        self.widget.after(LOG_INTERVAL, self._drain)
+
 
 TEXT = NewType('TEXT', str)
 CODE = NewType('CODE', str)
@@ -444,6 +468,10 @@ def main(
     output: TEXT,
     icon: Path,
 ):
+    # PIL takes a while to import and is only needed for the icon.
+    from PIL import Image
+    from PIL.ImageTk import PhotoImage
+
     icon = icon
     icon = Image.open(icon)
     icon = PhotoImage(icon)
@@ -10,20 +10,21 @@ from tkinter.filedialog import *
 from tkinter.ttk import *
 from pathlib import Path
 from dataclasses import dataclass
+from bisect import bisect_left
 import json
 import sys
+import threading
 
-from PIL import Image
-from PIL.ImageTk import PhotoImage
-import requests
-import tiktoken
 import _jsonnet
 
+from llmerick import Client, Dedupe, Memo, Prefetch, evaluate_fetching, add_budget_arguments, add_cache_arguments, add_daemon_arguments, add_metrics_arguments, budget_from_args, cache_from_args, daemon_from_args, metrics_from_args, HELPER_NATIVES, re_find_all as _re_find_all, split as _split
+
 
 DEFAULT_URL = 'https://api.openai.com/v1/chat/completions'
 DEFAULT_MODEL = 'gpt-3.5-turbo'
-OPENAI_API_KEY = (Path.home() / '.openai_api_key').read_text().strip()
-PRICING = 0.002 / 1000  # dollars/token
+LOG_INTERVAL = 100  # milliseconds
+LOG_MAX_LINES = 5000
+SYNC_DELAY = 500  # milliseconds
 
 
 def run(func):
@@ -44,21 +45,57 @@ def _configure_text_defaults(text: Text):
 
 
 class TextRedirector(object):
+    """File-like sink that mirrors writes into a Text widget.
+
+    Writes may come from any thread. They are queued and flushed into the
+    widget from the Tk main loop every LOG_INTERVAL milliseconds, one insert
+    per batch, and the widget is trimmed to its last LOG_MAX_LINES lines.
+    """
+
     def __init__(self, fileobj, widget, tag="stdout"):
         self.fileobj = fileobj
         self.widget = widget
         self.tag = tag
+        self._pending = []
+        self._lock = threading.Lock()
+        self.widget.after(LOG_INTERVAL, self._drain)
 
     def write(self, str):
-        self.widget.configure(state="normal")
-        self.widget.insert("end", str, (self.tag,))
-        self.widget.see('end')
-        self.widget.configure(state="disabled")
+        with self._lock:
+            self._pending.append(str)
         self.fileobj.write(str)
     
     def flush(self):
         self.fileobj.flush()
 
+    def _drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        if pending:
+            self.widget.configure(state="normal")
+            self.widget.insert("end", "".join(pending), (self.tag,))
+            lines = int(self.widget.index("end-1c").split(".")[0])
+            if lines > LOG_MAX_LINES:
+                self.widget.delete("1.0", f"{lines - LOG_MAX_LINES + 1}.0")
+            self.widget.see('end')
+            self.widget.configure(state="disabled")
+
+        self.widget.after(LOG_INTERVAL, self._drain)
+
+
+def _find_sections(value: str) -> List[Tuple[int, int]]:
+    """Return the (line, column) of every `##` in `value`, in order."""
+    sections = []
+    for line, text in enumerate(value.split('\n'), start=1):
+        if '##' not in text:
+            continue
+        column = text.find('##')
+        while column >= 0:
+            sections.append((line, column))
+            column = text.find('##', column + 2)
+    return sections
+
 
 class Editor(Frame):
     def __init__(self, master: Widget, *, value=None):
@@ -68,12 +105,16 @@ class Editor(Frame):
 
         self._value = \
         value = value or ''
+        self._sections = _find_sections(value)
+        self._dirty = False
+        self._sync_id = None
 
         self._var = \
         var = StringVar()
         var.set(self.value)
         def callback(name, index, mode):
             self._value = var.get()
+            self._sections = _find_sections(self._value)
         var.trace('w', callback)
 
         self._text = \
@@ -81,45 +122,53 @@ class Editor(Frame):
         text.grid(row=0, column=0, sticky='nsew')
         _configure_text_defaults(text)
         text.insert(END, var.get())
+        text.edit_modified(0)
         def callback(event):
-            var.set(text.get('1.0', END))
+            # Copying a large document out of the widget on every keystroke
+            # makes typing lag, so only note the edit here and copy once
+            # typing pauses or the value is needed.
+            if not text.edit_modified():
+                return
             text.edit_modified(0)
+            self._dirty = True
+            if self._sync_id is not None:
+                self.after_cancel(self._sync_id)
+            self._sync_id = self.after(SYNC_DELAY, self.sync)
         text.bind('<<Modified>>', callback)
         def callback(event):
-            def count(text, index, *, default=0):
-                x = text.count('1.0', index, '-chars')
-                if x is None:
-                    x = default
-                else:
-                    x = x[0]
-                return x
-
-            value = self._value
-            left = right = count(text, f'@{event.x},{event.y}')
-            # print(f'{left = !r}')
-            # print(f'{right = !r}')
-            # if ranges := text.tag_ranges(SEL):
-            #     left = count(text, SEL_FIRST, default=0)
-            #     right = count(text, SEL_LAST, default=len(value))
-            
-            left = value.rfind('##', 0, left)
-            if left < 0:
-                left = 0
+            self.sync()
+
+            # Select from the line after the `##` before the click up to
+            # the `##` after it.
+            line, column = map(int, text.index(f'@{event.x},{event.y}').split('.'))
+            i = bisect_left(self._sections, (line, column))
+
+            if i > 0:
+                left = f'{self._sections[i-1][0] + 1}.0'
             else:
-                nl = value.find('\n', left)
-                if nl >= 0:
-                    left = nl + 1
-            
-            right = value.find('##', right)
-            if right < 0:
-                right = len(value)
-            
+                left = '1.0'
+
+            if i < len(self._sections):
+                right = '{}.{}'.format(*self._sections[i])
+            else:
+                right = 'end-1c'
+
             text.tag_remove(SEL, '1.0', END)
-            text.tag_add(SEL, f'1.0+{left} chars', f'1.0+{right} chars')
+            text.tag_add(SEL, left, right)
         text.bind('<Control-Button-1>', callback)
 
+    def sync(self):
+        """Pull any pending edits from the text widget."""
+        if self._sync_id is not None:
+            self.after_cancel(self._sync_id)
+            self._sync_id = None
+        if self._dirty:
+            self._dirty = False
+            self._var.set(self._text.get('1.0', END))
+
     @property
     def value(self):
+        self.sync()
         return self._value
 
     @value.setter
@@ -131,59 +180,19 @@ class Editor(Frame):
         return self._text
 
 
-def _llmerick_split(document, *, new_tokens, old_tokens=0, model=DEFAULT_MODEL):
-    encoding = tiktoken.encoding_for_model(MODEL)
-    encode = encoding.encode_ordinary
-    decode = encoding.decode
-
-    fragments = []
+def _llmerick_split(document, *, new_tokens, old_tokens=0, snap=None, model=DEFAULT_MODEL):
+    return _split(document, new_tokens=new_tokens, old_tokens=old_tokens, snap=snap, model=model)
 
-    tokens = encode(document)
-    for i in range(0, len(tokens), new_tokens):
-        lo = i - old_tokens
-        lo = max(0, lo)
-        hi = i + new_tokens + 1
-        hi = min(len(tokens), hi)
-        chunk = tokens[lo:hi]
-        fragment = decode(chunk)
-        fragments.append(fragment)
 
-    return fragments
-
-
-def _llmerick_fetch(request):
-    with requests.post(
-        url=request.get('url', DEFAULT_URL),
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {OPENAI_API_KEY}',
-        },
-        json={
-            'model': request.get('model', DEFAULT_MODEL),
-            'messages': [
-                {
-                    'role': message['role'],
-                    'content': message['content'],
-                }
-                for message in request['messages']
-            ],
-        },
-        proxies={
-            'http': '',
-            'https': '',
-        },
-    ) as r:
-        return r.json()
+def _llmerick_fetch(request, *, client, on_delta=None):
+    return client.fetch(request, on_delta=on_delta)
 
 
 def _llmerick_re_find_all(needle: str, haystack: str) -> List[str]:
-    ret = []
-    for match in re.findall(needle, haystack):
-        ret.append(match)
-    return ret
+    return _re_find_all(needle, haystack)
 
 
-def llmerick(*, input: str, code: str) -> str:
+def llmerick(*, input: str, code: str, client: Client, memo: Optional[Memo] = None, prefetch: bool = False, on_delta: Optional[Callable[[str], None]] = None) -> str:
     try:
         input = json.loads(input)
     except json.JSONDecodeError:
@@ -193,17 +202,25 @@ def llmerick(*, input: str, code: str) -> str:
 
     native_callbacks = {}
     ext_codes = {}
+    dedupe = Dedupe(lambda request, **kwargs: _llmerick_fetch(request, client=client, **kwargs))
+
+    # With prefetch, LLMerick.fetch only collects requests; they are sent
+    # as one batch between passes.
+    prefetcher = None
+    if prefetch:
+        prefetcher = Prefetch()
 
     ext_codes['_llmerick_input'] = input
 
-    def split(document, new_tokens, old_tokens) -> List[str]:
-        return _llmerick_split(document, new_tokens=new_tokens, old_tokens=old_tokens)
+    def split(document, new_tokens, old_tokens, snap) -> List[str]:
+        return _llmerick_split(document, new_tokens=int(new_tokens), old_tokens=int(old_tokens), snap=snap)
     ext_codes['_llmerick_split_encode'] = (
-        r'''function(document, new_tokens, old_tokens=0)'''
+        r'''function(document, new_tokens, old_tokens=0, snap=null)'''
         r'''  std.manifestJsonMinified({'''
         r'''    document: document,'''
         r'''    new_tokens: new_tokens,'''
         r'''    old_tokens: old_tokens,'''
+        r'''    snap: snap,'''
         r'''  })'''
     )
     native_callbacks['_llmerick_split'] = (('args',), lambda args: split(**json.loads(args)))
@@ -215,8 +232,9 @@ def llmerick(*, input: str, code: str) -> str:
     def fetch(input) -> Response:
         input = json.loads(input)
         request = input['request']
-        response = _llmerick_fetch(
-            request=input['request'],
+        response = (prefetcher or dedupe)(
+            input['request'],
+            on_delta=on_delta,
         )
         output = { 'response': response }
         output = json.dumps(output)
@@ -233,32 +251,33 @@ def llmerick(*, input: str, code: str) -> str:
         r'''  std.parseJson(output).response'''
     )
 
-    def re_find_all(needle: str, haystack: str) -> List[str]:
-        return _llmerick_re_find_all(needle, haystack)
-    ext_codes['_llmerick_re_find_all_encode'] = (
-        r'''function(needle, haystack)'''
-        r'''  std.manifestJsonMinified({'''
-        r'''    needle: needle,'''
-        r'''    haystack: haystack,'''
-        r'''  })'''
-    )
-    native_callbacks['_llmerick_re_find_all'] = (('needle', 'haystack'), lambda args: re_find_all(**json.loads(args)))
-    ext_codes['_llmerick_re_find_all_decode'] = (
-        r'''function(matches)'''
-        r'''  matches'''
-    )
+    # These take only primitives, so they are called directly rather than
+    # through an encode/decode pair.
+    native_callbacks['_llmerick_re_find_all'] = (('needle', 'haystack'), _llmerick_re_find_all)
+    for name, native in HELPER_NATIVES.items():
+        native_callbacks[f'_llmerick_{name}'] = native
+
+    if memo is None:
+        memo = Memo(size=0)
 
     try:
-        output = _jsonnet.evaluate_snippet(
+        output = evaluate_fetching(
+            memo,
             '<code>',
             code,
             native_callbacks=native_callbacks,
             ext_codes=ext_codes,
+            client=client,
+            dedupe=dedupe,
+            fetches=('_llmerick_fetch',),
+            prefetch=prefetcher,
         )
         # print(f'{output = !r}')
     except:
         # print(_add_line_numbers(source))
         raise
+    finally:
+        dedupe.report()
     
     output = json.loads(output)
 
@@ -275,6 +294,8 @@ def main(
     right: Path,
     code: Path,
     lib: Path,
+    client: Client,
+    prefetch: bool,
 ):
     #/tk
     tk = Tk()
@@ -284,6 +305,10 @@ def main(
     tk.grid_rowconfigure(0, weight=1)
     tk.grid_columnconfigure(0, weight=1)
 
+    # PIL takes a while to import and is only needed for the icon.
+    from PIL import Image
+    from PIL.ImageTk import PhotoImage
+
     icon = icon
     icon = Image.open(icon)
     icon = PhotoImage(icon)
@@ -292,6 +317,9 @@ def main(
     style = Style(tk)
     style.configure('stacked.TNotebook', tabposition='nw', tabplacement='nw')
 
+    # Running the same selection again reuses the last evaluation.
+    memo = Memo()
+
     def _generic_run_code(*, input_editor, output_editor):
         def getselection(text, *, name):
             if ranges := text.tag_ranges(SEL):
@@ -303,10 +331,26 @@ def main(
         lib_text = getselection(lib_editor.text, name='lib')
         code_text = getselection(code_editor.text, name='code')
 
-        output_text = llmerick(input=input_text, code=lib_text + code_text)
         output_editor.text.mark_set(INSERT, END)
         output_editor.text.see(INSERT)
-        output_editor.text.insert(INSERT, '\n##\n' + output_text)
+        output_editor.text.insert(INSERT, '\n##\n')
+
+        # Streamed completions are shown as they arrive, then replaced by
+        # the evaluated output once the code finishes.
+        def on_delta(delta):
+            output_editor.text.insert(END, delta, ('stream',))
+            output_editor.text.see(END)
+            output_editor.text.update_idletasks()
+
+        try:
+            output_text = llmerick(input=input_text, code=lib_text + code_text, client=client, memo=memo, prefetch=prefetch, on_delta=on_delta)
+        finally:
+            if ranges := output_editor.text.tag_ranges('stream'):
+                output_editor.text.delete(ranges[0], ranges[-1])
+        client.report()
+        memo.report()
+        output_editor.text.insert(END, output_text)
+        output_editor.text.see(END)
 
     menu = Menu(tk)
     def callback():
@@ -406,9 +450,31 @@ def cli():
     parser.add_argument('--code', type=Path, default=Path('/dev/null'))
     parser.add_argument('--right', type=Path, default=Path('/dev/null'))
     parser.add_argument('--icon', type=icon, default=icon('VL'))
+    parser.add_argument('--stream', action='store_true', help='show completions as they are generated')
+    parser.add_argument('--concurrency', '-j', type=int, default=8)
+    parser.add_argument('--prefetch', action='store_true', help='collect the code\'s fetches and send them in parallel batches (may send extra requests built from values derived from pending responses)')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_budget_arguments(parser)
+    add_daemon_arguments(parser)
     args = vars(parser.parse_args())
 
-    main(**args)
+    client = Client(
+        url=DEFAULT_URL,
+        model=DEFAULT_MODEL,
+        concurrency=args.pop('concurrency'),
+        cache=cache_from_args(args),
+        stream=args.pop('stream'),
+        metrics=metrics_from_args(args),
+        budget=budget_from_args(args),
+        daemon=daemon_from_args(args),
+        proxies={
+            'http': '',
+            'https': '',
+        },
+    )
+
+    main(client=client, **args)
 
 
 if __name__ == '__main__':
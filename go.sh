@@ -8,11 +8,29 @@ project=${root##*/}
 #---
 
 llmerick() {
-    exec python3 "${root:?}/llmerick.py" \
+    # As a module, llmerick.py is loaded from its cached bytecode instead of
+    # being compiled afresh for every stage. With LLMERICK_DAEMON set (see
+    # go-Serve), the work is handed to that daemon.
+    PYTHONPATH=${root:?}${PYTHONPATH:+:${PYTHONPATH}} \
+    exec python3 -m llmerick \
+        ${LLMERICK_DAEMON:+--connect "${LLMERICK_DAEMON}"} \
         "$@" \
         ##
 }
 
+go-Serve() {
+    LLMERICK_DAEMON= \
+    llmerick \
+        --serve "${1:?}" \
+        "${@:2}"
+}
+
+go-Run() {
+    llmerick \
+        --code "${1:?}" \
+        "${@:2}"
+}
+
 go-Summarize() {
     for arg in "${@:2}"; do
         preprocess=${root:?}/summarize/preprocess.jsonnet \
@@ -34,35 +52,37 @@ go-Summarize() {
 go-Summarize-Preprocess() {
     <"${input:?}" \
     llmerick \
-        --preprocess-file "${preprocess:?}" \
+        --code "${preprocess:?}" \
     | tee "${inputs:?}"
 }
 
 go-Summarize-Encode() {
     <"${inputs:?}" \
     llmerick \
-        --encode-file "${encode:?}" \
+        --code "${encode:?}" \
     | tee "${requests:?}"
 }
 
 go-Summarize-Execute() {
     <"${requests:?}" \
     llmerick \
-        --execute \
+        --code-str "{ responses: std.native('fetch_all')(std.manifestJsonMinified(std.extVar('requests'))) }" \
     | tee "${responses:?}"
 }
 
 go-Summarize-Decode() {
     <"${responses:?}" \
     llmerick \
-        --decode-file "${decode:?}" \
+        --code "${decode:?}" \
     | tee "${outputs:?}"
 }
 
 go-Summarize-Postprocess() {
-    <"${outputs:?}" \
-    llmerick \
-        --postprocess-file "${postprocess:?}" \
+    # Needs the fragments from preprocess as well as the summaries.
+    python3 -c 'import json, sys; print(json.dumps({ k: v for path in sys.argv[1:] for k, v in json.load(open(path)).items() }))' \
+        "${inputs:?}" "${outputs:?}" \
+    | llmerick \
+        --code "${postprocess:?}" \
     | tee "${output:?}"
 }
 
@@ -4,19 +4,40 @@
 """
 
 from __future__ import annotations
+import time
+_STARTED = time.perf_counter()
+
 from pathlib import Path
 from dataclasses import dataclass, field
 import json
 import sys
 from io import StringIO
-from typing import NewType, TextIO, Dict, List, Any
+from typing import TYPE_CHECKING, NewType, TextIO, Dict, List, Any, Optional, Callable, Tuple
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+import contextlib
+import contextvars
+import functools
+import hashlib
+import importlib
+import os
 import pprint
+import random
 import re
+import threading
 
-import requests
-import tiktoken
+# These take longer to import than most stages take to run, and only the
+# stages that fetch or tokenize need them, so they are imported on first use
+# through _import.
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    import requests
+    import tiktoken
 import _jsonnet
 
+_IMPORTED = time.perf_counter()
+
 
 #--- Types
 
@@ -29,26 +50,1492 @@ Response = NewType('Response', Dict[str, Any])
 #--- Config
 
 ROOT = Path(__file__).resolve().parent
-OPENAI_API_KEY = (Path.home() / '.openai_api_key').read_text().strip()
-PRICING = 0.002 / 1000  # dollars/token
+DEFAULT_URL = 'https://api.openai.com/v1/chat/completions'
+DEFAULT_MODEL = 'gpt-3.5-turbo'
+PRICING = {  # dollars/token for (prompt, completion)
+    'gpt-3.5-turbo': (0.0015 / 1000, 0.002 / 1000),
+    'gpt-3.5-turbo-16k': (0.003 / 1000, 0.004 / 1000),
+    'gpt-4': (0.03 / 1000, 0.06 / 1000),
+    'gpt-4-32k': (0.06 / 1000, 0.12 / 1000),
+}
+CACHE_DIR = Path.home() / '.cache' / 'llmerick'
+CACHE_SIZE = 256  # megabytes
+POOL_SIZE = 8  # connections per host
+CONNECT_TIMEOUT = 10  # seconds
+READ_TIMEOUT = 600  # seconds
+RATE_HEADROOM = 0.9  # fraction of the rate limits to aim for
+MAX_RETRIES = 6
+TOKENIZER_THREADS = 8
+TOKENIZER_MEMO_SIZE = 65536  # distinct texts
+INDEX_STEP = 64  # tokens between stored offsets
+MEMO_SIZE = 64  # evaluations kept in memory
+MEMO_CACHE_SHARE = 0.25  # of --cache-size, for evaluations kept on disk
+MESSAGE_OVERHEAD = 4  # tokens the chat format adds per message
+REPLY_OVERHEAD = 3  # tokens that prime the reply
+COMPLETION_ALLOWANCE = 256  # tokens budgeted per completion
+COMPACT_FORMAT = 'llmerick/compact-2'
+COMPACT_FORMATS = ('llmerick/compact-1', COMPACT_FORMAT)  # read by expand(); -1 never escapes
+INTERN_MIN = 64  # characters; shorter strings are stored inline
+BATCH_SEPARATOR = '\x1e'  # joins string arrays; natives only take primitives
+REGEX_CACHE_SIZE = 256  # compiled patterns
+
+
+#--- Imports
+
+_import_times: Dict[str, float] = {}  # seconds, by module
+
+
+def _import(name: str):
+    """Import `name` on first use, noting how long that took for --timing."""
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    _import_times.setdefault(name, time.perf_counter() - start)
+    return module
+
+
+def report_timing(*, started: float, finished: float):
+    imports = ''.join(f'; {name} = {elapsed:0.3f}s' for name, elapsed in _import_times.items())
+    print(f'Timing: import = {_IMPORTED - _STARTED:0.3f}s; setup = {started - _IMPORTED:0.3f}s; run = {finished - started:0.3f}s{imports}', file=sys.stderr)
+
+
+#--- Tokenizer
+
+@functools.lru_cache(maxsize=None)
+def encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    return _import('tiktoken').encoding_for_model(model)
+
+
+_counts: Dict[Tuple[str, str], int] = {}
+_counts_lock = threading.Lock()
+
+
+def count_tokens(texts: List[str], *, model: str = DEFAULT_MODEL) -> List[int]:
+    """Count the tokens of each text.
+
+    Counts are memoized per (model, text), because the same system prompts
+    and context repeat across every request of a batch. Texts that have not
+    been seen before are encoded together, across threads.
+    """
+    counts = {}
+    with _counts_lock:
+        for text in texts:
+            if (count := _counts.get((model, text))) is not None:
+                counts[text] = count
+
+    missing = [
+        text
+        for text in dict.fromkeys(texts)
+        if text not in counts
+    ]
+    if missing:
+        encoded = encoding(model).encode_ordinary_batch(missing, num_threads=TOKENIZER_THREADS)
+        for text, tokens in zip(missing, encoded):
+            counts[text] = len(tokens)
+
+        with _counts_lock:
+            if len(_counts) + len(missing) > TOKENIZER_MEMO_SIZE:
+                _counts.clear()
+            for text in missing:
+                _counts[model, text] = counts[text]
+
+    return [
+        counts[text]
+        for text in texts
+    ]
+
+
+#--- Split
+
+SNAP_PATTERNS = {
+    'paragraph': re.compile(r'\n(?:[ \t]*\n)+'),
+    'sentence': re.compile(r'[.!?]["\')\]]*(?=\s)|\n(?:[ \t]*\n)+'),
+}
+
+
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+
+def _chars(data: bytes) -> int:
+    # The number of characters that start within some UTF-8 bytes.
+    return len(data.translate(None, _CONTINUATION_BYTES))
 
 
 @dataclass
-class Application:
-    pretty: bool
+class TokenIndex:
+    """A document, its tokens, and where those tokens fall in the document.
+
+    Any run of tokens maps straight to a slice of the original document, so
+    fragments never need to be decoded back from tokens. The index keeps the
+    character offset of every `INDEX_STEP`th token; any other offset is found
+    by decoding at most `INDEX_STEP` tokens from the nearest one.
+    """
+    document: str
+    tokens: List[int]
+    model: str
+    checkpoints: array  # characters started before each INDEX_STEP-th token
+
+    @classmethod
+    def from_document(cls, document: str, *, model: str = DEFAULT_MODEL) -> TokenIndex:
+        tokens = encoding(model).encode_ordinary(document)
+        decode_bytes = encoding(model).decode_bytes
+
+        checkpoints = array('q', [0])
+        for i in range(0, len(tokens), INDEX_STEP):
+            checkpoints.append(checkpoints[-1] + _chars(decode_bytes(tokens[i:i+INDEX_STEP])))
+
+        return cls(document=document, tokens=tokens, model=model, checkpoints=checkpoints)
+
+    def offset(self, k: int) -> int:
+        if k >= len(self.tokens):
+            return len(self.document)
+
+        i = k - k % INDEX_STEP
+        offset = self.checkpoints[i // INDEX_STEP] + _chars(encoding(self.model).decode_bytes(self.tokens[i:k]))
+
+        # A token that begins part way through a multi-byte character is
+        # placed at the start of that character.
+        if encoding(self.model).decode_single_token_bytes(self.tokens[k])[0] in _CONTINUATION_BYTES:
+            offset -= 1
+
+        return offset
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def text(self, lo: int, hi: int) -> str:
+        return self.document[self.offset(lo):self.offset(hi)]
+
+    def starts(self, new_tokens: int, *, snap: Optional[str] = None) -> List[int]:
+        """Token index at which each fragment starts.
+
+        With `snap`, each fragment ends at the last paragraph (or sentence)
+        break within its `new_tokens`, when there is one, so fragments are
+        at most `new_tokens` long.
+        """
+        if snap is None:
+            return list(range(0, len(self), new_tokens))
+
+        pattern = SNAP_PATTERNS[snap]
+
+        starts = [0]
+        while (i := starts[-1]) + new_tokens < len(self):
+            j = i + new_tokens
+
+            lo, hi = self.offset(i), self.offset(j)
+            end = None
+            for match in pattern.finditer(self.document, lo, hi):
+                end = match.end()
+
+            if end is not None and end > lo:
+                # The last token that starts at or before the break.
+                offsets = _Offsets(self)
+                j = max(i + 1, bisect_right(offsets, end, i + 1, j) - 1)
+
+            starts.append(j)
+
+        return starts
+
+
+class _Offsets:
+    # A read-only sequence view of TokenIndex.offset, for bisect.
+    def __init__(self, index: TokenIndex):
+        self.index = index
+
+    def __getitem__(self, k: int) -> int:
+        return self.index.offset(k)
+
+    def __len__(self) -> int:
+        return len(self.index) + 1
+
+
+def split(document: str, *, new_tokens: int, old_tokens: int = 0, snap: Optional[str] = None, model: str = DEFAULT_MODEL) -> List[str]:
+    """Split a document into fragments of `new_tokens` tokens.
+
+    Each fragment also repeats the `old_tokens` tokens before it. Unless
+    snapped to breaks, each fragment runs one token into the next.
+    """
+    # Fragments must move forward; a snapped split would otherwise never end.
+    if new_tokens < 1:
+        raise ValueError(f'new_tokens must be at least 1, not {new_tokens!r}')
+
+    index = TokenIndex.from_document(document, model=model)
+    starts = index.starts(new_tokens, snap=snap)
+
+    fragments = []
+    for i, j in zip(starts, starts[1:] + [len(index)]):
+        lo = max(0, i - old_tokens)
+        hi = j if snap is not None else min(len(index), j + 1)
+        fragments.append(index.text(lo, hi))
+
+    return fragments
+
+
+#--- Helpers
+
+def _unbatch(strings: str, count: int) -> Optional[List[str]]:
+    """Split `count` strings that were joined by BATCH_SEPARATOR.
+
+    Returns None when they do not split back into `count` pieces, i.e. one
+    of them contained the separator, so the caller can fall back.
+    """
+    count = int(count)
+    if count == 0:
+        return []
+
+    strings = strings.split(BATCH_SEPARATOR)
+    if len(strings) != count:
+        return None
+    return strings
+
+
+def group_index(keys: str, count: int) -> Optional[Dict[str, List[int]]]:
+    """Map each of `count` batched keys to its positions."""
+    keys = _unbatch(keys, count)
+    if keys is None:
+        return None
+
+    index = {}
+    for i, key in enumerate(keys):
+        index.setdefault(key, []).append(i)
+    return index
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_pattern(pattern: str) -> re.Pattern:
+    return re.compile(pattern)
+
+
+def re_find_all(pattern: str, string: str) -> List[Any]:
+    return compile_pattern(pattern).findall(string)
+
+
+def re_find_all_batch(pattern: str, strings: str, count: int) -> Optional[List[List[Any]]]:
+    strings = _unbatch(strings, count)
+    if strings is None:
+        return None
+
+    regex = compile_pattern(pattern)
+    return [regex.findall(string) for string in strings]
+
+
+def re_sub(pattern: str, repl: str, string: str) -> str:
+    return compile_pattern(pattern).sub(repl, string)
+
+
+def re_sub_batch(pattern: str, repl: str, strings: str, count: int) -> Optional[List[str]]:
+    strings = _unbatch(strings, count)
+    if strings is None:
+        return None
+
+    regex = compile_pattern(pattern)
+    return [regex.sub(repl, string) for string in strings]
+
+
+def re_split(pattern: str, string: str) -> List[Optional[str]]:
+    return compile_pattern(pattern).split(string)
+
+
+def re_split_batch(pattern: str, strings: str, count: int) -> Optional[List[List[Optional[str]]]]:
+    strings = _unbatch(strings, count)
+    if strings is None:
+        return None
+
+    regex = compile_pattern(pattern)
+    return [regex.split(string) for string in strings]
+
+
+def json_extract(path: str, document: str) -> Any:
+    """Parse `document` and follow the dotted `path` into it, e.g. 'items.0.name'.
+
+    Returns None when the document is not JSON or has nothing at `path`.
+    """
+    try:
+        value = json.loads(document)
+    except json.JSONDecodeError:
+        return None
+
+    for key in filter(None, path.split('.')):
+        if isinstance(value, list) and key.lstrip('-').isdigit() and -len(value) <= int(key) < len(value):
+            value = value[int(key)]
+        elif isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            return None
+    return value
+
+
+def json_extract_batch(path: str, documents: str, count: int) -> Optional[List[Any]]:
+    documents = _unbatch(documents, count)
+    if documents is None:
+        return None
+
+    return [json_extract(path, document) for document in documents]
+
+
+# The helpers as natives: name -> (params, func). Each batched native takes
+# its strings joined by BATCH_SEPARATOR plus their count, and returns null
+# if they did not survive the join, for the caller to redo one at a time.
+HELPER_NATIVES = {
+    'group_index': (('keys', 'count'), group_index),
+    're_find_all_batch': (('pattern', 'strings', 'count'), re_find_all_batch),
+    're_sub': (('pattern', 'repl', 'string'), re_sub),
+    're_sub_batch': (('pattern', 'repl', 'strings', 'count'), re_sub_batch),
+    're_split': (('pattern', 'string'), re_split),
+    're_split_batch': (('pattern', 'strings', 'count'), re_split_batch),
+    'json_extract': (('path', 'document'), json_extract),
+    'json_extract_batch': (('path', 'documents', 'count'), json_extract_batch),
+}
+
+
+#--- Cache
+
+@dataclass
+class Cache:
+    path: Path
+    max_bytes: int
+    hits: int = 0
+    misses: int = 0
+
+    def __post_init__(self):
+        self.path = Path(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Sizes are only needed to evict, so the directory is not scanned
+        # until the first put; a run that only reads starts at once.
+        self._sizes: Optional[Dict[Path, int]] = None
+        self._total = 0
+
+    def _scan(self):
+        if self._sizes is not None:
+            return
+
+        self._sizes = {}
+        for path in self.path.glob('*/*.json'):
+            try:
+                self._sizes[path] = path.stat().st_size
+            except FileNotFoundError:
+                pass
+        self._total = sum(self._sizes.values())
+
+    @staticmethod
+    def key(data: Any) -> str:
+        # Canonical JSON, so that the same request always hashes the same way
+        # regardless of key order or whitespace.
+        data = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.path / key[:2] / f'{key}.json'
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            value = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # The modification time doubles as the "last used" time for eviction.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file and rename it into place, so that a
+        # concurrent reader never sees a partially written entry.
+        temp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        temp.write_text(json.dumps(value))
+        os.replace(temp, path)
+
+        size = path.stat().st_size
+        with self._lock:
+            self._scan()
+            self._total += size - self._sizes.get(path, 0)
+            self._sizes[path] = size
+            self._evict()
+
+    def _evict(self):
+        if self._total <= self.max_bytes:
+            return
+
+        def mtime(path):
+            try:
+                return path.stat().st_mtime
+            except FileNotFoundError:
+                return 0
+
+        for path in sorted(self._sizes, key=mtime):
+            if self._total <= self.max_bytes:
+                break
+
+            path.unlink(missing_ok=True)
+            self._total -= self._sizes.pop(path)
+
+    def report(self):
+        size = '' if self._sizes is None else f'; size = {self._total / 2**20:0.1f}MB'
+        print(f'Cache: hits = {self.hits!r}; misses = {self.misses!r}{size}', file=sys.stderr)
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-dir', dest='cache_dir', type=Path, default=CACHE_DIR)
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=CACHE_SIZE, help='megabytes')
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None)
+
+
+def cache_from_args(args: Dict[str, Any]) -> Optional[Cache]:
+    cache_dir = args.pop('cache_dir')
+    cache_size = args.pop('cache_size')
+    if cache_dir is None:
+        return None
+
+    return Cache(cache_dir, max_bytes=cache_size * 2**20)
+
+
+#--- Evaluation
+
+_imports: Dict[str, Tuple[Tuple[int, int], bytes, str]] = {}
+_imports_lock = threading.Lock()
+
+
+def _read_import(path: str) -> Tuple[bytes, str]:
+    """Return the contents of an imported file and their digest.
+
+    Files are only re-read when their size or modification time changes.
+    """
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _imports_lock:
+        entry = _imports.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1], entry[2]
+
+    content = Path(path).read_bytes()
+    digest = hashlib.sha256(content).hexdigest()
+    with _imports_lock:
+        _imports[path] = (version, content, digest)
+
+    return content, digest
+
+
+@functools.lru_cache(maxsize=None)
+def _memo_version() -> str:
+    # Memoized outputs depend on the natives defined here, so a change to
+    # this file must not be answered with results from before it.
+    return hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+
+@dataclass
+class Memo:
+    """Results of Jsonnet evaluations, keyed on the source and its inputs.
+
+    The most recent `size` results are kept in memory; with `cache`, every
+    result is also kept on disk for later processes. A result is reused only
+    while the files it imported are unchanged, and is not kept at all if it
+    called one of the `volatile` natives, whose results may differ from one
+    call to the next (e.g. uncached completions), or if `keep` says not to.
+    """
+    size: int = MEMO_SIZE
+    cache: Optional[Cache] = None
+    hits: int = 0
+    misses: int = 0
+    saved: float = 0.0  # seconds
+
+    def __post_init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None and self.cache is not None:
+            entry = self.cache.get(key)
+
+        if entry is None:
+            return None
+
+        for path, digest in entry['imports'].items():
+            try:
+                if _read_import(path)[1] != digest:
+                    return None
+            except OSError:
+                return None
+
+        return entry
+
+    def _put(self, key: str, entry: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        if self.cache is not None:
+            self.cache.put(key, entry)
+
+    def evaluate(
+        self,
+        filename: str,
+        source: str,
+        *,
+        native_callbacks: Dict[str, Tuple[Tuple[str, ...], Callable]],
+        ext_codes: Dict[str, str],
+        volatile: Tuple[str, ...] = (),
+        keep: Optional[Callable[[], bool]] = None,
+        scope: Optional[Dict[str, Any]] = None,
+        imported: Optional[Dict[str, str]] = None,
+    ) -> str:
+        # `scope` is whatever else the natives' results depend on, e.g. the
+        # client's url and model. `imported`, if given, is filled with the
+        # digest of every file the evaluation imported.
+        key = Cache.key({
+            'version': _memo_version(),
+            'filename': filename,
+            'source': source,
+            'ext_codes': ext_codes,
+            'scope': scope,
+        })
+
+        if (entry := self._get(key)) is not None:
+            with self._lock:
+                self.hits += 1
+                self.saved += entry['elapsed']
+            if imported is not None:
+                imported.update(entry['imports'])
+            return entry['output']
+
+        with self._lock:
+            self.misses += 1
+
+        imports = {}
+        def import_callback(dir: str, rel: str) -> Tuple[str, bytes]:
+            path = os.path.normpath(os.path.join(dir, rel))
+            content, imports[path] = _read_import(path)
+            return path, content
+
+        called = []
+        native_callbacks = dict(native_callbacks)
+        for name in volatile:
+            if name not in native_callbacks:
+                continue
+            params, func = native_callbacks[name]
+            def wrapper(*args, func=func):
+                called.append(True)
+                return func(*args)
+            native_callbacks[name] = (params, wrapper)
+
+        start = time.perf_counter()
+        output = _jsonnet.evaluate_snippet(
+            filename,
+            source,
+            native_callbacks=native_callbacks,
+            ext_codes=ext_codes,
+            import_callback=import_callback,
+        )
+        elapsed = time.perf_counter() - start
+
+        if imported is not None:
+            imported.update(imports)
+
+        if not called and (keep is None or keep()):
+            self._put(key, {
+                'output': output,
+                'elapsed': elapsed,
+                'imports': imports,
+            })
+
+        return output
+
+    def report(self):
+        # A hit fetches nothing, so whatever its evaluation fetched the first
+        # time is missing from the Metrics and --trace of this run.
+        note = ''
+        if self.hits:
+            note = ' (requests of hits are not in Metrics or --trace)'
+        if self.hits or self.misses:
+            print(f'Memo: hits = {self.hits!r}; misses = {self.misses!r}; saved = {self.saved:0.3f}s{note}', file=sys.stderr)
+
+
+#--- Metrics
+
+@functools.lru_cache(maxsize=None)
+def _pricing(model: str) -> Tuple[float, float]:
+    base = max((name for name in PRICING if model.startswith(name)), key=len, default=None)
+    if base is not None:
+        return PRICING[base]
+
+    # Priced high rather than low, so that --max-cost is never too lenient.
+    base = max(PRICING, key=lambda name: sum(PRICING[name]))
+    print(f'Price: unknown model {model!r}; priced as {base!r}', file=sys.stderr)
+    return PRICING[base]
+
+
+def price(model: str, *, prompt_tokens: int, completion_tokens: int = 0) -> float:
+    """Return the cost in dollars of a request to `model`.
+
+    Dated snapshots (e.g. gpt-4-0613) are priced as their base model, and
+    unknown models, with a warning, as the most expensive known one.
+    """
+    prompt, completion = _pricing(model)
+    return prompt_tokens * prompt + completion_tokens * completion
+
+
+@dataclass
+class Metrics:
+    """Per-request telemetry: tokens, latency, retries, cache hits and cost.
+
+    Every request is totalled per model and, with `trace`, written to it as
+    one JSON line, tagged with the stage being evaluated at the time.
+    """
+    trace: Optional[TextIO] = None
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self.totals: Dict[str, Dict[str, float]] = {}
+        # The daemon shares one Metrics between concurrent jobs, so the
+        # current stage belongs to the job's context, not to the Metrics.
+        self._stage = contextvars.ContextVar('stage', default=None)
+
+    @contextlib.contextmanager
+    def stage(self, name: Optional[str]):
+        token = self._stage.set(name)
+        try:
+            yield
+        finally:
+            self._stage.reset(token)
+
+    def record(self, *, model: str, prompt_tokens: int, completion_tokens: int, latency: float, retries: int = 0, cached: bool = False):
+        event = {
+            'time': time.time(),
+            'stage': self._stage.get(),
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'latency': latency,
+            'retries': retries,
+            'cached': cached,
+            'cost': 0.0 if cached else price(model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens),
+        }
+
+        with self._lock:
+            totals = self.totals.setdefault(model, dict.fromkeys(['requests', 'cached', 'prompt_tokens', 'completion_tokens', 'latency', 'retries', 'cost'], 0))
+            totals['requests'] += 1
+            totals['cached'] += cached
+            for k in ('prompt_tokens', 'completion_tokens', 'latency', 'retries', 'cost'):
+                totals[k] += event[k]
+
+            if self.trace is not None:
+                self.trace.write(json.dumps(event) + '\n')
+                self.trace.flush()
+
+    def report(self):
+        for model, totals in self.totals.items():
+            print(
+                f'Metrics: {model = !s}; requests = {totals["requests"]!r}; cached = {totals["cached"]!r}; '
+                f'prompt_tokens = {totals["prompt_tokens"]!r}; completion_tokens = {totals["completion_tokens"]!r}; '
+                f'latency = {totals["latency"] / totals["requests"]:0.3f}s (mean); retries = {totals["retries"]!r}; '
+                f'cost = ${totals["cost"]:0.3f}',
+                file=sys.stderr,
+            )
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--trace', dest='trace', type=lambda s: open(s, 'at'), help='append a JSON line per request to this file')
+
+
+def metrics_from_args(args: Dict[str, Any]) -> Metrics:
+    return Metrics(trace=args.pop('trace'))
+
+
+#--- Budget
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+@dataclass
+class Budget:
+    """Limits on the tokens and dollars that a run may spend.
+
+    Requests are estimated before they are sent: their prompt tokens, as
+    the server counts them, plus `allowance` tokens for each completion.
+    The actual usage of each response is charged as it arrives.
+    """
+    max_cost: Optional[float] = None  # dollars
+    max_tokens: Optional[int] = None
+    allowance: int = COMPLETION_ALLOWANCE
+    cost: float = 0.0
+    tokens: int = 0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def _over(self, tokens: int, cost: float) -> bool:
+        return (
+            self.max_tokens is not None and tokens > self.max_tokens
+            or self.max_cost is not None and cost > self.max_cost
+        )
+
+    def _limits(self) -> str:
+        limits = []
+        if self.max_tokens is not None:
+            limits.append(f'{self.max_tokens!r} tokens')
+        if self.max_cost is not None:
+            limits.append(f'${self.max_cost:0.3f}')
+        return ' / '.join(limits)
+
+    def _estimate(self, request: Request) -> Tuple[int, float]:
+        prompt_tokens = _prompt_tokens(request, model=request['model'])
+        cost = price(request['model'], prompt_tokens=prompt_tokens, completion_tokens=self.allowance)
+        return prompt_tokens + self.allowance, cost
+
+    def fits(self, requests: List[Request]) -> int:
+        """Return how many of the leading `requests` fit in what is left."""
+        with self._lock:
+            tokens, cost = self.tokens, self.cost
+
+        for n, request in enumerate(requests):
+            request_tokens, request_cost = self._estimate(request)
+            tokens += request_tokens
+            cost += request_cost
+            if self._over(tokens, cost):
+                return n
+
+        return len(requests)
+
+    def check(self, requests: List[Request]):
+        if self.fits(requests) == len(requests):
+            return
+
+        estimates = [self._estimate(request) for request in requests]
+        tokens = sum(tokens for tokens, _ in estimates)
+        cost = sum(cost for _, cost in estimates)
+        raise BudgetExceeded(
+            f'{len(requests)!r} requests are estimated at {tokens!r} tokens / ${cost:0.3f}, '
+            f'which with {self.tokens!r} tokens / ${self.cost:0.3f} already spent exceeds the budget of {self._limits()}'
+        )
+
+    def charge(self, *, model: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self.tokens += prompt_tokens + completion_tokens
+            self.cost += price(model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            tokens, cost = self.tokens, self.cost
+
+        if self._over(tokens, cost):
+            raise BudgetExceeded(f'Spent {tokens!r} tokens / ${cost:0.3f}, over the budget of {self._limits()}')
+
+    def report(self, requests: List[Request], *, model: str = DEFAULT_MODEL):
+        estimates = [self._estimate({ 'model': model, **request }) for request in requests]
+        tokens = sum(tokens for tokens, _ in estimates)
+        cost = sum(cost for _, cost in estimates)
+        print(
+            f'Budget: requests = {len(requests)!r}; estimate = {tokens!r} tokens / ${cost:0.3f}; '
+            f'spent = {self.tokens!r} tokens / ${self.cost:0.3f}; limit = {self._limits()}',
+            file=sys.stderr,
+        )
+
+
+def add_budget_arguments(parser):
+    parser.add_argument('--max-cost', dest='max_cost', type=float, default=None, help='dollars')
+    parser.add_argument('--max-tokens', dest='max_tokens', type=int, default=None)
+    parser.add_argument('--completion-allowance', dest='completion_allowance', type=int, default=COMPLETION_ALLOWANCE, help='tokens to budget for each completion')
+
+
+def budget_from_args(args: Dict[str, Any]) -> Optional[Budget]:
+    max_cost = args.pop('max_cost')
+    max_tokens = args.pop('max_tokens')
+    allowance = args.pop('completion_allowance')
+    if max_cost is None and max_tokens is None:
+        return None
+
+    return Budget(max_cost=max_cost, max_tokens=max_tokens, allowance=allowance)
+
+
+#--- Session
+
+@functools.lru_cache(maxsize=None)
+def openai_api_key() -> str:
+    return (Path.home() / '.openai_api_key').read_text().strip()
+
+
+_sessions: Dict[int, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def session(*, pool_size: int = POOL_SIZE) -> requests.Session:
+    # One session per process (and pool size), so that every fetch path
+    # shares the same keep-alive connections instead of paying a new TCP and
+    # TLS handshake per request.
+    requests = _import('requests')
+
+    with _sessions_lock:
+        if pool_size not in _sessions:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+            )
+
+            s = requests.Session()
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            s.headers.update({
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {openai_api_key()}',
+            })
+
+            _sessions[pool_size] = s
+
+        return _sessions[pool_size]
+
+
+#--- Scheduler
+
+def _prompt_tokens(request: Request, *, model: str) -> int:
+    return sum(count_tokens([
+        message['content']
+        for message in request['messages']
+    ], model=model)) + MESSAGE_OVERHEAD * len(request['messages']) + REPLY_OVERHEAD
+
+
+def _retry_after(r: requests.Response) -> Optional[float]:
+    if (value := r.headers.get('retry-after-ms')) is not None:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+
+    if (value := r.headers.get('retry-after')) is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        # An HTTP-date that has already passed means "retry now".
+        try:
+            return max(0.0, _import('email.utils').parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    return None
+
+
+@dataclass
+class Scheduler:
+    rpm: Optional[int] = None  # requests/minute
+    tpm: Optional[int] = None  # tokens/minute
+    max_retries: int = MAX_RETRIES
+    backoff: float = 1.0  # seconds
+    max_backoff: float = 60.0  # seconds
+    retries: int = 0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._window = deque()  # [time, tokens] for the last minute
+        self._paused_until = 0.0
+
+    def _acquire(self, tokens: int) -> List:
+        # Block until sending one more request of `tokens` tokens keeps the
+        # last minute's totals under the (headroom-adjusted) rate limits.
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._window and self._window[0][0] <= now - 60:
+                    self._window.popleft()
+
+                wait = self._paused_until - now
+                if wait <= 0 and self.rpm is not None:
+                    if len(self._window) + 1 > max(1, self.rpm * RATE_HEADROOM):
+                        wait = self._window[0][0] + 60 - now
+                if wait <= 0 and self.tpm is not None and self._window:
+                    if sum(n for _, n in self._window) + tokens > self.tpm * RATE_HEADROOM:
+                        wait = self._window[0][0] + 60 - now
+
+                if wait <= 0:
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    return entry
+
+            time.sleep(wait)
+
+    def _delay(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def __call__(self, send: Callable[[], requests.Response], *, tokens: int = 0, on_retry: Optional[Callable[[], None]] = None) -> requests.Response:
+        requests = _import('requests')
+
+        for attempt in range(self.max_retries + 1):
+            entry = self._acquire(tokens)
+
+            try:
+                r = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                reason = f'{type(e).__name__}'
+                delay = self._delay(attempt)
+            else:
+                if r.ok:
+                    # A streamed body has not been read yet, and reading it
+                    # here would consume it.
+                    if not r.headers.get('content-type', '').startswith('text/event-stream'):
+                        try:
+                            entry[1] = r.json()['usage']['total_tokens']
+                        except (ValueError, KeyError, TypeError):
+                            pass
+                    return r
+
+                if r.status_code != 429 and r.status_code < 500 or attempt == self.max_retries:
+                    raise requests.HTTPError(f'{r.status_code} {r.reason}: {r.text}', response=r)
+
+                reason = f'{r.status_code} {r.reason}'
+                delay = _retry_after(r)
+                if delay is None:
+                    delay = self._delay(attempt)
+
+                # A 429 applies to the whole account, so hold back every
+                # request, not just this one.
+                if r.status_code == 429:
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+            with self._lock:
+                self.retries += 1
+            if on_retry is not None:
+                on_retry()
+            print(f'Retrying in {delay:0.1f}s ({attempt + 1}/{self.max_retries}): {reason}', file=sys.stderr)
+            time.sleep(delay)
+
+
+#--- Streaming
+
+def _read_stream(r: requests.Response, data: Dict[str, Any], *, on_delta: Optional[Callable[[str], None]] = None) -> Response:
+    # Server-sent events: one `data: {chunk}` line per delta, ending with
+    # `data: [DONE]`.
+    response = {}
+    role = 'assistant'
+    content = []
+    finish_reason = None
+
+    for line in r.iter_lines(decode_unicode=False):
+        if not line.startswith(b'data:'):
+            continue
+
+        line = line[len(b'data:'):].strip()
+        if line == b'[DONE]':
+            break
+
+        chunk = json.loads(line)
+        for k in ('id', 'object', 'created', 'model', 'usage'):
+            if chunk.get(k) is not None:
+                response[k] = chunk[k]
+
+        for choice in chunk.get('choices', []):
+            delta = choice.get('delta', {})
+            role = delta.get('role', role)
+            if delta.get('content'):
+                content.append(delta['content'])
+                if on_delta is not None:
+                    on_delta(delta['content'])
+            finish_reason = choice.get('finish_reason') or finish_reason
+
+    content = ''.join(content)
+    response.update({
+        'object': 'chat.completion',
+        'choices': [
+            {
+                'index': 0,
+                'message': {
+                    'role': role,
+                    'content': content,
+                },
+                'finish_reason': finish_reason,
+            },
+        ],
+    })
+
+    # Servers that ignore `include_usage` do not report usage for streams,
+    # so count it the way the server would have, near enough.
+    if 'usage' not in response:
+        prompt_tokens = _prompt_tokens(data, model=data['model'])
+        completion_tokens, = count_tokens([content], model=data['model'])
+        response['usage'] = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+
+    return response
+
+
+#--- Client
+
+@dataclass
+class Client:
     url: str
     model: str
+    concurrency: int = 1
+    cache: Optional[Cache] = None
+    proxies: Optional[Dict[str, str]] = None
+    pool_size: int = POOL_SIZE
+    timeout: float = READ_TIMEOUT
+    scheduler: Scheduler = field(default_factory=Scheduler)
+    stream: bool = False
+    metrics: Metrics = field(default_factory=Metrics)
+    budget: Optional[Budget] = None
+    daemon: Optional[Path] = None
+
+    def _prepare(self, request: Request) -> Tuple[str, bool, Dict[str, Any]]:
+        url = request.get('url', self.url)
+        stream = request.get('stream', self.stream)
+        data = {
+            'model': request.get('model', self.model),
+            'messages': [
+                {
+                    'role': message['role'],
+                    'content': message['content'],
+                }
+                for message in request['messages']
+            ],
+        }
+        return url, stream, data
+
+    def preflight(self, requests: List[Request], *, truncate: bool = False) -> List[Request]:
+        """Check `requests` against the budget before sending any of them.
+
+        Requests already in the cache cost nothing. If the rest do not fit,
+        raise BudgetExceeded or, with `truncate`, return the longest prefix
+        of `requests` that does fit.
+        """
+        if self.budget is None:
+            return requests
+
+        uncached = []
+        for i, request in enumerate(requests):
+            url, _, data = self._prepare(request)
+            if self.cache is None or Cache.key({ 'url': url, **data }) not in self.cache:
+                uncached.append((i, data))
+
+        self.budget.report([data for _, data in uncached])
+
+        n = self.budget.fits([data for _, data in uncached])
+        if n == len(uncached):
+            return requests
+
+        if not truncate:
+            self.budget.check([data for _, data in uncached])
+
+        print(f'Budget: sending {uncached[n][0]!r} of {len(requests)!r} requests', file=sys.stderr)
+        return requests[:uncached[n][0]]
+
+    def fetch(self, request: Request, *, on_delta: Optional[Callable[[str], None]] = None) -> Response:
+        """Send one chat completion request and return its response.
+
+        When streaming (`stream: true` in the request, or `self.stream`),
+        each piece of content is passed to `on_delta` as it arrives, and the
+        pieces are assembled into the same response a non-streamed request
+        would have returned.
+        """
+        url, stream, data = self._prepare(request)
+
+        # The daemon keeps its own cache, metrics and budget.
+        if self.daemon is not None:
+            message = { 'fetch': { **request, 'url': url, 'model': data['model'], 'stream': stream } }
+            return submit(self.daemon, message, on_delta=on_delta)['response']
+
+        start = time.perf_counter()
+        retries = 0
+        def record(response, *, cached=False):
+            usage = response.get('usage') or {}
+            self.metrics.record(
+                model=data['model'],
+                prompt_tokens=usage.get('prompt_tokens', 0),
+                completion_tokens=usage.get('completion_tokens', 0),
+                latency=time.perf_counter() - start,
+                retries=retries,
+                cached=cached,
+            )
+
+        key = None
+        if self.cache is not None:
+            key = Cache.key({ 'url': url, **data })
+            if (response := self.cache.get(key)) is not None:
+                if stream and on_delta is not None:
+                    on_delta(response['choices'][0]['message']['content'])
+                record(response, cached=True)
+                return response
+
+        if self.budget is not None:
+            self.budget.check([data])
+
+        tokens = 0
+        if self.scheduler.tpm is not None:
+            tokens = _prompt_tokens(data, model=data['model'])
+
+        def send():
+            return session(pool_size=self.pool_size).post(
+                url=url,
+                json={ **data, 'stream': True, 'stream_options': { 'include_usage': True } } if stream else data,
+                proxies=self.proxies,
+                timeout=(CONNECT_TIMEOUT, self.timeout),
+                stream=stream,
+            )
+
+        def on_retry():
+            nonlocal retries
+            retries += 1
+
+        r = self.scheduler(send, tokens=tokens, on_retry=on_retry)
+        if stream:
+            with r:
+                response = _read_stream(r, data, on_delta=on_delta)
+        else:
+            response = r.json()
+
+        if key is not None:
+            self.cache.put(key, response)
+
+        record(response)
+
+        # The response is kept either way, but nothing more is sent once the
+        # actual usage has gone over budget.
+        if self.budget is not None:
+            usage = response.get('usage') or {}
+            self.budget.charge(
+                model=data['model'],
+                prompt_tokens=usage.get('prompt_tokens', 0),
+                completion_tokens=usage.get('completion_tokens', 0),
+            )
+
+        return response
+
+    def fetch_all(self, requests: List[Request], *, fetch: Optional[Callable[[Request], Response]] = None) -> List[Response]:
+        self.preflight(requests)
+
+        # Each request is independent, so run up to `concurrency` of them at
+        # once. `map` yields results in submission order, not completion
+        # order, so the responses line up with the requests. Each runs in a
+        # copy of the caller's context, which holds the Metrics stage.
+        fetch = fetch or self.fetch
+        context = contextvars.copy_context()
+        with _import('concurrent.futures').ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            return list(executor.map(lambda request: context.copy().run(fetch, request), requests))
+
+    def report(self):
+        self.metrics.report()
+        if self.cache is not None:
+            self.cache.report()
+        if self.scheduler.retries:
+            print(f'Scheduler: retries = {self.scheduler.retries!r}', file=sys.stderr)
+
+
+#--- Dedupe
+
+@dataclass
+class Dedupe:
+    """Wraps a fetch so that identical requests are only sent once.
+
+    Jsonnet does not memoize field references, so a template that refers
+    to the same response from two places fetches it twice. One Dedupe lives
+    for one evaluation: the first caller of a request sends it, and any
+    caller with an identical request, whether it arrives before or after
+    the response does, waits for and shares that result.
+    """
+    fetch: Callable[..., Response]
+    duplicates: int = 0
+
+    def __post_init__(self):
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, request: Request, **kwargs) -> Response:
+        key = Cache.key(request)
+
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = _import('concurrent.futures').Future()
+            else:
+                self.duplicates += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            future.set_result(self.fetch(request, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future.result()
+
+    def report(self):
+        if self.duplicates:
+            print(f'Dedupe: duplicates = {self.duplicates!r}', file=sys.stderr)
+
+
+#--- Prefetch
+
+PENDING = '<llmerick:pending>'
+
+
+@dataclass
+class Prefetch:
+    """Stands in for fetch while looking for a template's requests.
+
+    Requests that already have a response get it. Others are collected in
+    `pending` and answered with a placeholder whose content is PENDING, so
+    that evaluation can run on and find more requests to send in the same
+    batch. A request built from a placeholder contains PENDING itself; it is
+    not collected, and is found on a later pass once the real content is in.
+
+    A request built from something derived from a placeholder (its length, a
+    count of matches in it, ...) does not contain PENDING and is sent as is,
+    so --prefetch can send extra requests that a plain run would not.
+    """
+    responses: Dict[str, Response] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.pending: Dict[str, Request] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, request: Request, **kwargs) -> Response:
+        key = Cache.key(request)
+
+        with self._lock:
+            if key in self.responses:
+                return self.responses[key]
+            if PENDING not in json.dumps(request):
+                self.pending[key] = request
+
+        return {
+            'choices': [
+                {
+                    'index': 0,
+                    'message': { 'role': 'assistant', 'content': PENDING },
+                    'finish_reason': None,
+                },
+            ],
+            'usage': { 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0 },
+        }
+
+    def fill(self, fetch_all: Callable[[List[Request]], List[Response]]):
+        pending, self.pending = self.pending, {}
+        self.responses.update(zip(pending, fetch_all(list(pending.values()))))
+
+
+def evaluate_fetching(
+    memo: Memo,
+    filename: str,
+    source: str,
+    *,
+    native_callbacks: Dict[str, Tuple[Tuple[str, ...], Callable]],
+    ext_codes: Dict[str, str],
+    client: Client,
+    dedupe: Dedupe,
+    fetches: Tuple[str, ...],
+    prefetch: Optional[Prefetch] = None,
+    imported: Optional[Dict[str, str]] = None,
+) -> str:
+    """Evaluate code whose `fetches` natives send requests through `dedupe`.
+
+    With `prefetch`, the code is evaluated again after each batch of the
+    requests it collected is sent, until a pass collects none.
+    """
+    # Without a response cache, asking again may give a different
+    # completion, so evaluations that fetch cannot be reused.
+    volatile = ()
+    if client.cache is None:
+        volatile = fetches
+
+    # A pass that was given placeholders must not be remembered.
+    keep = None
+    if prefetch is not None:
+        keep = lambda: not prefetch.pending
+
+    while True:
+        try:
+            output = memo.evaluate(
+                filename,
+                source,
+                native_callbacks=native_callbacks,
+                ext_codes=ext_codes,
+                volatile=volatile,
+                keep=keep,
+                scope={ 'url': client.url, 'model': client.model },
+                imported=imported,
+            )
+        except Exception:
+            # The code may have choked on a placeholder, which the real
+            # response will fix.
+            if prefetch is None or not prefetch.pending:
+                raise
+
+        if prefetch is None or not prefetch.pending:
+            return output
+
+        print(f'Prefetch: requests = {len(prefetch.pending)!r}', file=sys.stderr)
+        prefetch.fill(lambda requests: client.fetch_all(requests, fetch=dedupe))
+
+
+#--- Compact
+
+def _is_response(value: Any) -> bool:
+    return (
+        isinstance(value, dict)
+        and isinstance(value.get('choices'), list)
+        and 'usage' in value
+        and all(isinstance(choice, dict) and 'message' in choice for choice in value['choices'])
+    )
+
+
+def _is_marker(value: Dict[str, Any]) -> bool:
+    return len(value) == 1 and ('$ref' in value or '$escape' in value)
+
+
+def compact(value: Any) -> Dict[str, Any]:
+    """Return `value` in the compact artifact format.
+
+    Every string of at least INTERN_MIN characters is stored once, in a
+    table keyed by its digest, and replaced by `{"$ref": digest}` wherever
+    it occurs; so a system prompt shared by a thousand requests is written
+    once. Chat completion responses are cut down to their messages, usage
+    and model, which cost.py prices them by.
+
+    A one-key object of the data itself that would read as a marker, such
+    as a JSON Schema's `{"$ref": ...}`, is wrapped as `{"$escape": ...}`.
+    """
+    strings = {}
+    digests = {}
+
+    def visit(value):
+        if isinstance(value, str):
+            if len(value) < INTERN_MIN:
+                return value
+            if (digest := digests.get(value)) is None:
+                digest = digests[value] = hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+                strings[digest] = value
+            return { '$ref': digest }
+
+        if isinstance(value, list):
+            return [visit(item) for item in value]
+
+        if isinstance(value, dict):
+            if _is_response(value):
+                value = {
+                    **({ 'model': value['model'] } if 'model' in value else {}),
+                    'choices': [{ 'message': choice['message'] } for choice in value['choices']],
+                    'usage': value['usage'],
+                }
+            if _is_marker(value):
+                return { '$escape': { k: visit(v) for k, v in value.items() } }
+            return { k: visit(v) for k, v in value.items() }
+
+        return value
+
+    value = visit(value)
+    return { '$llmerick': COMPACT_FORMAT, 'strings': strings, 'value': value }
+
+
+def expand(data: Any) -> Any:
+    """Undo compact(); anything not in the compact format is returned as is.
+
+    Each interned string is shared by all of the places that refer to it.
+
+    >>> expand(compact({ 'schema': { '$ref': '#/definitions/x' }, 'escaped': { '$escape': 1 } }))
+    {'schema': {'$ref': '#/definitions/x'}, 'escaped': {'$escape': 1}}
+    """
+    if not isinstance(data, dict) or data.get('$llmerick') not in COMPACT_FORMATS:
+        return data
+
+    strings = data['strings']
+
+    def visit(value):
+        if isinstance(value, list):
+            return [visit(item) for item in value]
+
+        if isinstance(value, dict):
+            if len(value) == 1 and '$ref' in value:
+                return strings[value['$ref']]
+            if len(value) == 1 and '$escape' in value:
+                return { k: visit(v) for k, v in value['$escape'].items() }
+            return { k: visit(v) for k, v in value.items() }
+
+        return value
+
+    return visit(data['value'])
+
+
+#--- Stages
+
+STAGE_HEADER = re.compile(r'^##(\w+)[ \t]*$', re.MULTILINE)
+
+
+def parse_stages(source: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """Split a .llmerick file into its prelude and its ##stage sections.
+
+    Each stage's source is the prelude followed by that stage's section,
+    padded with blank lines so that Jsonnet error messages still point at
+    the right line of the original file.
+    """
+    matches = list(STAGE_HEADER.finditer(source))
+    if not matches:
+        return source, []
+
+    prelude = source[:matches[0].start()]
+
+    stages = []
+    for match, next in zip(matches, matches[1:] + [None]):
+        skipped = source[len(prelude):match.start()]
+        section = source[match.start():next.start() if next else len(source)]
+        stages.append((match.group(1), prelude + '\n' * skipped.count('\n') + section))
+
+    return prelude, stages
+
+
+@dataclass
+class Application:
+    pretty: bool
+    client: Client
 
     reader: TextIO
     writer: TextIO
 
     code: Code
+    jsonl: bool = False
+    from_stage: Optional[str] = None
+    to_stage: Optional[str] = None
+    work_dir: Optional[Path] = None
+    incremental: bool = False
+    prefetch: bool = False
+    compact: bool = False
+    memo: Memo = field(default_factory=Memo)
 
 
     #--- Utilities
 
-    def _jsonnet(self, context: json, filename: str, source: str):
+    def _jsonnet(self, context: json, filename: str, source: str, *, ext_codes: Optional[Dict[str, str]] = None, imported: Optional[Dict[str, str]] = None):
         native_callbacks = {}
+        dedupe = Dedupe(self.client.fetch)
+
+        # With prefetch, the natives only collect requests; they are sent as
+        # one batch between passes.
+        prefetch = None
+        if self.prefetch:
+            prefetch = Prefetch()
 
         def split(document: str, new_tokens: str, old_tokens: str) -> List[str]:
             new_tokens = int(new_tokens)
@@ -56,19 +1543,34 @@ class Application:
             return self._split(document, new_tokens=new_tokens, old_tokens=old_tokens)
         native_callbacks['split'] = (('document', 'new_tokens', 'old_tokens'), split)
 
+        def split_snapped(document: str, new_tokens: str, old_tokens: str, snap: str) -> List[str]:
+            new_tokens = int(new_tokens)
+            old_tokens = int(old_tokens)
+            return self._split(document, new_tokens=new_tokens, old_tokens=old_tokens, snap=snap)
+        native_callbacks['split_snapped'] = (('document', 'new_tokens', 'old_tokens', 'snap'), split_snapped)
+
         def fetch(request: str) -> Response:
             request = json.loads(request)
             print(f'{request = !r}', file=sys.stderr)
-            return self._fetch(request)
+            return self._fetch(request, fetch=prefetch or dedupe)
         native_callbacks['fetch'] = (('request',), fetch)
 
+        def fetch_all(requests: str) -> List[Response]:
+            requests = json.loads(requests)
+            print(f'{len(requests) = !r}; {self.client.concurrency = !r}', file=sys.stderr)
+            return self._fetch_all(requests, fetch=prefetch or dedupe)
+        native_callbacks['fetch_all'] = (('requests',), fetch_all)
+
         def re_find_all(needle: str, haystack: str) -> List[str]:
             return self._re_find_all(needle, haystack)
         native_callbacks['re_find_all'] = (('needle', 'haystack'), re_find_all)
 
-        ext_codes = {}
-        for k, v in context.items():
-            ext_codes[k] = json.dumps(v)
+        native_callbacks.update(HELPER_NATIVES)
+
+        if ext_codes is None:
+            ext_codes = {}
+            for k, v in context.items():
+                ext_codes[k] = json.dumps(v)
 
         def _add_line_numbers(source):
             lines = []
@@ -78,77 +1580,189 @@ class Application:
             return "\n".join(lines)
 
         try:
-            output = _jsonnet.evaluate_snippet(
+            output = evaluate_fetching(
+                self.memo,
                 filename,
                 source,
                 native_callbacks=native_callbacks,
                 ext_codes=ext_codes,
+                client=self.client,
+                dedupe=dedupe,
+                fetches=('fetch', 'fetch_all'),
+                prefetch=prefetch,
+                imported=imported,
             )
         except:
             print(_add_line_numbers(source))
             raise
+        finally:
+            dedupe.report()
 
         try:
             return json.loads(output)
         except json.JSONDecodeError:
             return output
 
-    def _split(self, document, *, new_tokens, old_tokens=0):
-        encoding = tiktoken.encoding_for_model(MODEL)
-        encode = encoding.encode_ordinary
-        decode = encoding.decode
-
-        fragments = []
-
-        tokens = encode(document)
-        for i in range(0, len(tokens), new_tokens):
-            lo = i - old_tokens
-            lo = max(0, lo)
-            hi = i + new_tokens + 1
-            hi = min(len(tokens), hi)
-            chunk = tokens[lo:hi]
-            fragment = decode(chunk)
-            fragments.append(fragment)
-
-        return fragments
-
-    def _fetch(self, request: Request) -> Response:
-        with requests.post(
-            url=request.get('url', self.url),
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {OPENAI_API_KEY}',
-            },
-            json={
-                'model': request.get('model', self.model),
-                'messages': [
-                    {
-                        'role': message['role'],
-                        'content': message['content'],
-                    }
-                    for message in request['messages']
-                ],
-            },
-        ) as r:
-            return r.json()
+    def _split(self, document, *, new_tokens, old_tokens=0, snap=None):
+        return split(document, new_tokens=new_tokens, old_tokens=old_tokens, snap=snap, model=self.client.model)
+
+    def _fetch(self, request: Request, *, fetch: Callable[..., Response]) -> Response:
+        def on_delta(delta: str):
+            print(delta, end='', file=sys.stderr, flush=True)
+
+        response = fetch(request, on_delta=on_delta)
+        if request.get('stream', self.client.stream):
+            print(file=sys.stderr)
+
+        return response
+
+    def _fetch_all(self, requests: List[Request], *, fetch: Callable[..., Response]) -> List[Response]:
+        # While prefetching nothing is sent, so there is nothing to budget
+        # for or run in parallel yet.
+        if isinstance(fetch, Prefetch):
+            return [fetch(request) for request in requests]
+
+        return self.client.fetch_all(requests, fetch=fetch)
 
     def _re_find_all(self, needle: str, haystack: str) -> List[str]:
-        ret = []
-        for match in re.findall(needle, haystack):
-            ret.append(match)
-        return ret
+        return re_find_all(needle, haystack)
 
     #--- Main
 
     def __call__(self):
-        context = self.reader.read()
-        
+        if self.jsonl:
+            self._call_jsonl()
+        else:
+            self._call()
+
+        self.client.report()
+        self.memo.report()
+
+    def _evaluate(self, context: Dict[str, Any], source: str) -> Any:
+        _, stages = parse_stages(source)
+        if not stages:
+            return self._jsonnet(context, self.code.name, source)
+
+        names = [name for name, _ in stages]
+        for name in (self.from_stage, self.to_stage):
+            if name is not None and name not in names:
+                raise ValueError(f'Unknown stage {name!r}; expected one of {names!r}')
+
+        lo = names.index(self.from_stage) if self.from_stage is not None else 0
+        hi = names.index(self.to_stage) + 1 if self.to_stage is not None else len(names)
+
+        # Every value is serialized to Jsonnet once, when it is produced, and
+        # reused by each later stage that sees it. Its digest is kept
+        # alongside, so that a stage's fingerprint covers its inputs without
+        # rehashing them each time.
+        context = dict(context)
+        ext_codes = {
+            k: json.dumps(v)
+            for k, v in context.items()
+        }
+        digests = {
+            k: hashlib.sha256(v.encode('utf-8')).hexdigest()
+            for k, v in ext_codes.items()
+        }
+
+        for name, source in stages[lo:hi]:
+            fingerprint = Cache.key({
+                'source': source,
+                'inputs': digests,
+                'url': self.client.url,
+                'model': self.client.model,
+            })
+
+            output = None
+            if self.incremental:
+                output = self._load_stage(name, fingerprint)
+
+            if output is not None:
+                print(f'Stage: {name} (unchanged)', file=sys.stderr)
+            else:
+                print(f'Stage: {name}', file=sys.stderr)
+
+                # The files the stage imports are only known once it has
+                # run, so their digests are saved with the fingerprint and
+                # checked again when loading.
+                imported = {}
+                with self.client.metrics.stage(name):
+                    output = self._jsonnet(context, self.code.name, source, ext_codes=ext_codes, imported=imported)
+                if not isinstance(output, dict):
+                    output = { 'output': output }
+
+                if self.work_dir is not None:
+                    self._save_stage(name, output, fingerprint=fingerprint, imported=imported)
+
+            context.update(output)
+            for k, v in output.items():
+                ext_codes[k] = json.dumps(v)
+                digests[k] = hashlib.sha256(ext_codes[k].encode('utf-8')).hexdigest()
+
+        return context
+
+    def _dumps(self, value: Any) -> str:
+        if self.compact:
+            value = compact(value)
+        return json.dumps(value)
+
+    def _save_stage(self, name: str, output: Dict[str, Any], *, fingerprint: Optional[str] = None, imported: Optional[Dict[str, str]] = None):
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        (self.work_dir / f'{name}.json').write_text(self._dumps(output))
+
+        # Written last, so that an interrupted save never leaves a matching
+        # fingerprint next to a stale output.
+        if fingerprint is not None:
+            (self.work_dir / f'{name}.fingerprint').write_text(json.dumps({
+                'fingerprint': fingerprint,
+                'imports': imported or {},
+            }))
+
+    def _load_stage(self, name: str, fingerprint: str) -> Optional[Dict[str, Any]]:
         try:
-            context = json.loads(context)
-        except json.JSONDecodeError:
-            context = { 'input': context }
+            saved = json.loads((self.work_dir / f'{name}.fingerprint').read_text())
+            if not isinstance(saved, dict) or saved.get('fingerprint') != fingerprint:
+                return None
+            for path, digest in saved['imports'].items():
+                if _read_import(path)[1] != digest:
+                    return None
+            return expand(json.loads((self.work_dir / f'{name}.json').read_text()))
+        except (OSError, KeyError, json.JSONDecodeError):
+            return None
+
+    def _load_stages(self, source: str) -> Optional[Dict[str, Any]]:
+        # When resuming part way through, the earlier stages' outputs come
+        # from the work directory instead of being recomputed.
+        if self.from_stage is None or self.work_dir is None:
+            return None
 
-        context = self._jsonnet(context, self.code.name, self.code.read())
+        _, stages = parse_stages(source)
+        names = [name for name, _ in stages]
+        if self.from_stage not in names:
+            return None
+
+        context = expand(json.loads((self.work_dir / 'input.json').read_text()))
+        for name in names[:names.index(self.from_stage)]:
+            context.update(expand(json.loads((self.work_dir / f'{name}.json').read_text())))
+
+        return context
+
+    def _call(self):
+        source = self.code.read()
+
+        context = self._load_stages(source)
+        if context is None:
+            context = self.reader.read()
+            
+            try:
+                context = expand(json.loads(context))
+            except json.JSONDecodeError:
+                context = { 'input': context }
+
+            if self.work_dir is not None:
+                self._save_stage('input', context)
+
+        context = self._evaluate(context, source)
 
         try:
             context = context['output']
@@ -156,34 +1770,318 @@ class Application:
             if self.pretty:
                 context = pprint.pformat(context, width=120, compact=True, sort_dicts=False)
             else:
-                context = json.dumps(context)
+                context = self._dumps(context)
 
         self.writer.write(context)
 
+    def _call_jsonl(self):
+        # One record in, one record out. Each line is evaluated and written
+        # as soon as it is read, so that the next stage in a pipeline can
+        # start on it while this one is still working on the rest.
+        source = self.code.read()
 
-def cli():
-    def fakefile(s, name='StringIO'):
-        s = StringIO(s)
-        s.name = name
-        return s
+        for line in self.reader:
+            if not line.strip():
+                continue
 
+            try:
+                context = expand(json.loads(line))
+            except json.JSONDecodeError:
+                context = line.rstrip('\n')
+
+            if not isinstance(context, dict):
+                context = { 'input': context }
+
+            context = self._evaluate(context, source)
+
+            try:
+                context = context['output']
+            except (KeyError, TypeError):
+                pass
+
+            self.writer.write(self._dumps(context) + '\n')
+            self.writer.flush()
+
+
+#--- Daemon
+
+class DaemonError(RuntimeError):
+    pass
+
+
+def _fakefile(s: str, name: str = 'StringIO') -> StringIO:
+    s = StringIO(s)
+    s.name = name
+    return s
+
+
+# The parts of an Application a job may choose; the client and the caches
+# belong to the daemon.
+JOB_OPTIONS = ('pretty', 'jsonl', 'from_stage', 'to_stage', 'work_dir', 'incremental', 'compact', 'prefetch')
+
+
+@dataclass
+class Daemon:
+    """Runs jobs sent over a Unix socket in one long-lived process.
+
+    Every job shares the daemon's client, so its response cache, connection
+    pool, rate limits and budget, along with the tokenizer and the
+    evaluation memo; jobs run concurrently, one thread per connection. A
+    connection carries one line of JSON and gets back lines of JSON: any
+    `delta`s, then the result or an `error`.
+
+        {"run": {"code": ..., "name": ..., "input": ..., "options": {...}}}
+            -> {"output": ...}
+        {"fetch": request}
+            -> {"delta": ...}... {"response": ...}
+    """
+    path: Path
+    client: Client
+    memo: Memo = field(default_factory=Memo)
+
+    def _run(self, job: Dict[str, Any]) -> str:
+        options = job.get('options', {})
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown options {sorted(unknown)!r}; expected some of {JOB_OPTIONS!r}')
+        if options.get('work_dir') is not None:
+            options['work_dir'] = Path(options['work_dir'])
+
+        writer = StringIO()
+        app = Application(
+            client=self.client,
+            memo=self.memo,
+            reader=StringIO(job['input']),
+            writer=writer,
+            code=_fakefile(job['code'], job['name']),
+            pretty=options.pop('pretty', False),
+            **options,
+        )
+        app()
+
+        return writer.getvalue()
+
+    def _handle(self, reader, writer):
+        def send(message):
+            writer.write(json.dumps(message).encode('utf-8') + b'\n')
+            writer.flush()
+
+        try:
+            message = json.loads(reader.readline())
+            if 'run' in message:
+                send({ 'output': self._run(message['run']) })
+            elif 'fetch' in message:
+                on_delta = lambda delta: send({ 'delta': delta })
+                send({ 'response': self.client.fetch(message['fetch'], on_delta=on_delta) })
+            else:
+                raise ValueError(f'Unknown message {sorted(message)!r}; expected run or fetch')
+        except Exception as e:
+            print(f'Daemon: {type(e).__name__}: {e}', file=sys.stderr)
+            send({ 'error': f'{type(e).__name__}: {e}' })
+
+    def serve(self):
+        socketserver = _import('socketserver')
+
+        # A socket file nobody answers on is left over from a daemon that
+        # did not shut down cleanly.
+        if self.path.is_socket():
+            try:
+                submit(self.path, {})
+            except ConnectionRefusedError:
+                self.path.unlink()
+            except DaemonError:
+                raise DaemonError(f'{self.path} is already being served')
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon._handle(self.rfile, self.wfile)
+
+        server = socketserver.ThreadingUnixStreamServer(str(self.path), Handler)
+        server.daemon_threads = True
+
+        # Stop as cleanly on `kill` as on Ctrl-C.
+        import signal
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        print(f'Daemon: listening on {self.path}', file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.path.unlink(missing_ok=True)
+            self.client.report()
+            self.memo.report()
+
+
+def submit(path: Path, message: Dict[str, Any], *, on_delta: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Send one message to the Daemon at `path` and return its reply."""
+    socket = _import('socket')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(str(path))
+        s.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with s.makefile('rb') as reader:
+            for line in reader:
+                reply = json.loads(line)
+                if 'delta' in reply:
+                    if on_delta is not None:
+                        on_delta(reply['delta'])
+                elif 'error' in reply:
+                    raise DaemonError(reply['error'])
+                else:
+                    return reply
+
+    raise DaemonError(f'{path} closed the connection without replying')
+
+
+def submit_job(path: Path, *, code: Code, reader: TextIO, writer: TextIO, **options):
+    # Imports are resolved by the daemon, so it needs the code's full path.
+    name = code.name
+    if not name.startswith('<'):
+        name = str(Path(name).resolve())
+    if options.get('work_dir') is not None:
+        options['work_dir'] = str(options['work_dir'].resolve())
+
+    reply = submit(path, { 'run': {
+        'code': code.read(),
+        'name': name,
+        'input': reader.read(),
+        'options': options,
+    } })
+    writer.write(reply['output'])
+
+
+def add_daemon_arguments(parser):
+    parser.add_argument('--connect', dest='daemon', type=Path, metavar='SOCKET', help='hand the work to a running `llmerick.py --serve SOCKET`')
+
+
+def daemon_from_args(args: Dict[str, Any]) -> Optional[Path]:
+    return args.pop('daemon')
+
+
+def cli():
     import argparse, sys
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--url', dest='url', default='https://api.openai.com/v1/chat/completions')
-    parser.add_argument('--model', dest='model', default='gpt-3.5-turbo')
+    parser.add_argument('--url', dest='url', default=DEFAULT_URL)
+    parser.add_argument('--model', dest='model', default=DEFAULT_MODEL)
+    parser.add_argument('--concurrency', '-j', dest='concurrency', type=int, default=8)
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=POOL_SIZE)
+    parser.add_argument('--timeout', dest='timeout', type=float, default=READ_TIMEOUT, help='seconds')
+    parser.add_argument('--rpm', dest='rpm', type=int, default=None, help='requests/minute limit')
+    parser.add_argument('--tpm', dest='tpm', type=int, default=None, help='tokens/minute limit')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=MAX_RETRIES)
+    parser.add_argument('--stream', action='store_true', help='stream completions, echoing them to stderr')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_budget_arguments(parser)
     parser.add_argument('--input', '-i', dest='reader', type=argparse.FileType('rt'), default=sys.stdin)
     parser.add_argument('--output', '-o', dest='writer', type=argparse.FileType('wt'), default=sys.stdout)
     def add_code_argument(parser, *, flag, dest):
         parser.add_argument(f'{flag}', dest=f'{dest}', type=argparse.FileType('rt'))
-        parser.add_argument(f'{flag}-str', dest=f'{dest}', type=lambda s: fakefile(s, f"<{flag}>"))
+        parser.add_argument(f'{flag}-str', dest=f'{dest}', type=lambda s: _fakefile(s, f"<{flag}>"))
     add_code_argument(parser, flag='--code', dest='code')
     parser.add_argument('--pretty', action='store_true')
+    parser.add_argument('--jsonl', action='store_true', help='evaluate once per line of input')
+    parser.add_argument('--from-stage', dest='from_stage', help='first ##stage to run')
+    parser.add_argument('--to-stage', dest='to_stage', help='last ##stage to run')
+    parser.add_argument('--work-dir', dest='work_dir', type=Path, help='save (and resume from) each stage\'s output')
+    parser.add_argument('--incremental', action='store_true', help='skip stages whose source and inputs are unchanged since the last run')
+    parser.add_argument('--compact', action='store_true', help='write JSON output and stage files with repeated strings stored once (read back transparently)')
+    parser.add_argument('--prefetch', action='store_true', help='collect each evaluation\'s fetches and send them in parallel batches (may send extra requests built from values derived from pending responses)')
+    parser.add_argument('--timing', action='store_true', help='report the time spent importing, setting up and running to stderr')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--serve', dest='serve', type=Path, metavar='SOCKET', help='run jobs sent to SOCKET by --connect, sharing caches and connections between them')
+    add_daemon_arguments(group)
     args = vars(parser.parse_args())
 
-    app = Application(**args)
+    timing = args.pop('timing')
+    serve = args.pop('serve')
+    daemon = daemon_from_args(args)
+
+    if args['incremental'] and args['work_dir'] is None:
+        parser.error('--incremental requires --work-dir')
+
+    # Every record would save over the same stage files.
+    if args['jsonl'] and args['work_dir'] is not None:
+        parser.error('--work-dir cannot be used with --jsonl')
+
+    # Everything else, starting with the client and its cache, is the
+    # daemon's.
+    if daemon is not None:
+        if args['code'] is None:
+            parser.error('--connect requires --code')
+
+        # These would be silently ignored: they are fixed when the daemon
+        # is started with --serve.
+        for dest, flag in {
+            'url': '--url',
+            'model': '--model',
+            'concurrency': '--concurrency',
+            'pool_size': '--pool-size',
+            'timeout': '--timeout',
+            'rpm': '--rpm',
+            'tpm': '--tpm',
+            'max_retries': '--max-retries',
+            'stream': '--stream',
+            'cache_dir': '--cache-dir/--no-cache',
+            'cache_size': '--cache-size',
+            'trace': '--trace',
+            'max_cost': '--max-cost',
+            'max_tokens': '--max-tokens',
+            'completion_allowance': '--completion-allowance',
+        }.items():
+            if args[dest] != parser.get_default(dest):
+                parser.error(f'{flag} cannot be used with --connect; pass it to --serve instead')
+
+        started = time.perf_counter()
+        submit_job(daemon, **{ k: args[k] for k in ('code', 'reader', 'writer', *JOB_OPTIONS) })
+
+        if timing:
+            report_timing(started=started, finished=time.perf_counter())
+        return
+
+    client = Client(
+        url=args.pop('url'),
+        model=args.pop('model'),
+        concurrency=args.pop('concurrency'),
+        cache=cache_from_args(args),
+        pool_size=args.pop('pool_size'),
+        timeout=args.pop('timeout'),
+        scheduler=Scheduler(
+            rpm=args.pop('rpm'),
+            tpm=args.pop('tpm'),
+            max_retries=args.pop('max_retries'),
+        ),
+        stream=args.pop('stream'),
+        metrics=metrics_from_args(args),
+        budget=budget_from_args(args),
+    )
+
+    # Evaluations are kept on disk in their own corner of the response cache,
+    # and take their share of --cache-size from it.
+    memo = Memo()
+    if client.cache is not None:
+        memo_bytes = int(client.cache.max_bytes * MEMO_CACHE_SHARE)
+        client.cache.max_bytes -= memo_bytes
+        memo.cache = Cache(client.cache.path / 'evaluations', max_bytes=memo_bytes)
+
+    if serve is not None:
+        Daemon(serve, client=client, memo=memo).serve()
+        return
+
+    app = Application(client=client, memo=memo, **args)
+
+    started = time.perf_counter()
     app()
 
+    if timing:
+        report_timing(started=started, finished=time.perf_counter())
+
 
 if __name__ == '__main__':
     cli()
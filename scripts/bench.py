@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from typing import Dict, List, Any, Optional, Tuple
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+#--- Config
+
+ROOT = Path(__file__).resolve().parent.parent
+MODEL = 'gpt-3.5-turbo'
+WORDS = '''
+    the of and to in is that for it as was with be by on not he this are or
+    his from at which but have an they you were her she there been one all
+    visualization service data parallel state request response user device
+'''.split()
+
+TEMPLATE_STAGES = ['preprocess', 'encode', 'execute', 'decode']
+
+sys.path.insert(0, str(ROOT))
+import llmerick
+
+
+#--- Utilities
+
+def synthetic_document(size: int, *, seed: int = 0) -> str:
+    rng = random.Random(seed)
+
+    paragraphs = []
+    length = 0
+    while length < size:
+        sentences = []
+        for _ in range(rng.randint(2, 8)):
+            words = rng.choices(WORDS, k=rng.randint(5, 25))
+            sentences.append(' '.join(words).capitalize() + '.')
+
+        paragraph = ' '.join(sentences)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+
+    return '\n\n'.join(paragraphs)[:size]
+
+
+def best_of(func, *, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+#--- Split
+
+def _reference_split(document, *, new_tokens, old_tokens=0, model=MODEL):
+    # The implementation that llmerick.split replaced: decode every
+    # overlapping window of tokens separately.
+    encode = llmerick.encoding(model).encode_ordinary
+    decode = llmerick.encoding(model).decode
+
+    fragments = []
+
+    tokens = encode(document)
+    for i in range(0, len(tokens), new_tokens):
+        lo = i - old_tokens
+        lo = max(0, lo)
+        hi = i + new_tokens + 1
+        hi = min(len(tokens), hi)
+        chunk = tokens[lo:hi]
+        fragment = decode(chunk)
+        fragments.append(fragment)
+
+    return fragments
+
+
+def bench_split(*, sizes: List[float], new_tokens: int, old_tokens: int, repeat: int):
+    # Load the encoding and the per-token tables outside of the timings.
+    llmerick.split(synthetic_document(1024), new_tokens=new_tokens, old_tokens=old_tokens, model=MODEL)
+
+    for size in sizes:
+        document = synthetic_document(int(size * 2**20))
+
+        reference = best_of(lambda: _reference_split(document, new_tokens=new_tokens, old_tokens=old_tokens), repeat=repeat)
+        indexed = best_of(lambda: llmerick.split(document, new_tokens=new_tokens, old_tokens=old_tokens, model=MODEL), repeat=repeat)
+        snapped = best_of(lambda: llmerick.split(document, new_tokens=new_tokens, old_tokens=old_tokens, snap='paragraph', model=MODEL), repeat=repeat)
+
+        print(f'split: size = {size:0.1f}MB; reference = {reference:0.3f}s; indexed = {indexed:0.3f}s ({reference / indexed:0.1f}x); snapped = {snapped:0.3f}s')
+
+
+#--- Helpers
+
+# The helpers as the templates write them locally; groupBy's fold layers the
+# object once per element. grouper, zip and zipWithIndex are not here: the
+# std versions are the templates' own std.makeArray code, so there is
+# nothing to compare them with.
+HELPERS_LOCAL = """
+local std = LLMerick.std + {
+  groupBy(keyfunc, arr)::
+    local each(acc, x) = acc + { [keyfunc(x)] +: [x] };
+    std.foldl(each, arr, {}),
+};
+"""
+HELPERS_STD = """
+local std = LLMerick.std;
+"""
+HELPER_CASES = {
+    'groupBy': 'std.length(std.objectFields(std.groupBy(function(x) x, arr)))',
+}
+
+
+def _evaluate_helper(code: str, arr: str, queue: multiprocessing.Queue):
+    import _jsonnet
+
+    native_callbacks = {}
+    native_callbacks['_llmerick_group_index'] = (('keys', 'count'), llmerick.group_index)
+
+    start = time.perf_counter()
+    _jsonnet.evaluate_snippet('<bench>', code, ext_codes={ 'arr': arr }, native_callbacks=native_callbacks)
+    queue.put(time.perf_counter() - start)
+
+
+def _time_helper(code: str, arr: str, *, timeout: float) -> Tuple[Optional[float], str]:
+    # In a child process: the fold can exhaust the stack, or simply take
+    # longer than anyone would wait.
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_evaluate_helper, args=(code, arr, queue))
+    process.start()
+    process.join(timeout)
+
+    if process.is_alive():
+        process.kill()
+        process.join()
+        return None, f'>{timeout:0.0f}s'
+    if process.exitcode != 0:
+        return None, f'failed ({process.exitcode})'
+
+    elapsed = queue.get()
+    return elapsed, f'{elapsed:0.3f}s'
+
+
+def bench_helpers(*, helpers: List[str], sizes: List[int], per_key: int, timeout: float):
+    stdlib = (ROOT / 'stdlib.llmerick').read_text()
+
+    for size in sizes:
+        # As in rate-story-coherence: a handful of ratings per paragraph.
+        arr = json.dumps([f'paragraph {i // per_key}' for i in range(size)])
+
+        for name in helpers:
+            code = f'local arr = std.extVar("arr");\n{HELPER_CASES[name]}'
+            before, before_text = _time_helper(stdlib + HELPERS_LOCAL + code, arr, timeout=timeout)
+            after, after_text = _time_helper(stdlib + HELPERS_STD + code, arr, timeout=timeout)
+
+            speedup = ''
+            if before is not None and after is not None:
+                speedup = f' ({before / after:0.1f}x)'
+
+            print(f'{name}: size = {size}; local = {before_text}; std = {after_text}{speedup}')
+
+
+#--- Mock server
+
+class MockServer(ThreadingHTTPServer):
+    """A stand-in for the chat completions API.
+
+    Every request waits `latency` seconds, fails with a 500 at `error_rate`,
+    and is refused with a 429 and a Retry-After once more than `rpm` have
+    arrived in the last minute. The reply's content echoes the size of the
+    prompt and ends in a rating, so that the bundled templates can parse it.
+    """
+    daemon_threads = True
+
+    def __init__(self, *, latency: float = 0.1, error_rate: float = 0.0, rpm: Optional[int] = None, port: int = 0):
+        super().__init__(('127.0.0.1', port), _MockHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._window = deque()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1/chat/completions'
+
+    def _admit(self) -> Optional[int]:
+        # Returns the status to fail with, if any.
+        with self._lock:
+            self.requests += 1
+
+            now = time.monotonic()
+            while self._window and self._window[0] <= now - 60:
+                self._window.popleft()
+
+            status = None
+            if self.rpm is not None and len(self._window) >= self.rpm:
+                status = 429
+            elif random.random() < self.error_rate:
+                status = 500
+            else:
+                self._window.append(now)
+
+            if status is not None:
+                self.errors += 1
+            return status
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, data: Any, headers: Dict[str, str] = {}):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.server.latency)
+
+        if (status := self.server._admit()) is not None:
+            self._send(status, { 'error': { 'message': 'mock failure' } }, { 'Retry-After': '1' } if status == 429 else {})
+            return
+
+        prompt_tokens = sum(len(message['content'].split()) for message in data['messages'])
+        content = f'This is a mock reply to {prompt_tokens} words. Rating: {prompt_tokens % 10 + 1}/10'
+        completion_tokens = len(content.split())
+
+        if not data.get('stream'):
+            self._send(200, {
+                'object': 'chat.completion',
+                'model': data['model'],
+                'choices': [{ 'index': 0, 'message': { 'role': 'assistant', 'content': content }, 'finish_reason': 'stop' }],
+                'usage': { 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens },
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for word in content.split(' '):
+            chunk = { 'choices': [{ 'index': 0, 'delta': { 'content': word + ' ' }, 'finish_reason': None }] }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        usage = { 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens }
+        self.wfile.write(f'data: {json.dumps({ "choices": [], "usage": usage })}\n\n'.encode('utf-8'))
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+
+def serve(*, port: int, latency: float, error_rate: float, rpm: Optional[int]):
+    with MockServer(port=port, latency=latency, error_rate=error_rate, rpm=rpm) as server:
+        print(f'Serving on {server.url}', file=sys.stderr)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+#--- Templates
+
+SUMMARIZE_STAGES = ['preprocess', 'encode', 'execute', 'decode', 'postprocess']
+EXECUTE_CODE = "{ responses: std.native('fetch_all')(std.manifestJsonMinified(std.extVar('requests'))) }"
+VISUAL_CODE = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from VisualLLMerick import llmerick
+from llmerick import Client
+code = open(sys.argv[2]).read() + open(sys.argv[3]).read()
+client = Client(url=sys.argv[4], model=sys.argv[5], concurrency=int(sys.argv[6]))
+print(llmerick(input=sys.stdin.read(), code=code, client=client, prefetch=sys.argv[7] == 'prefetch'))
+"""
+
+
+def _run(args: List[str], *, env: Dict[str, str], stdin: Path, stdout: Path) -> Tuple[float, int]:
+    """Run a process and return its wall time and peak RSS in kilobytes."""
+    log = stdout.with_suffix('.log')
+
+    start = time.perf_counter()
+    with open(stdin, 'rb') as reader, open(stdout, 'wb') as writer, open(log, 'wb') as logger:
+        process = subprocess.Popen(args, env=env, stdin=reader, stdout=writer, stderr=logger)
+        _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f'{args[1]} exited with {process.returncode}:\n{log.read_text()[-2000:]}')
+
+    return elapsed, rusage.ru_maxrss
+
+
+def _llmerick_args(*, url: str, concurrency: int, prefetch: bool) -> List[str]:
+    args = [sys.executable, str(ROOT / 'llmerick.py'), '--no-cache', '--url', url, '--model', MODEL, '--concurrency', str(concurrency)]
+    if prefetch:
+        args.append('--prefetch')
+    return args
+
+
+def _bench_rate_story_coherence(document: Path, work: Path, *, env, url, concurrency, prefetch):
+    args = _llmerick_args(url=url, concurrency=concurrency, prefetch=prefetch)
+    return _run([*args, '--code', str(ROOT / 'rate-story-coherence.llmerick')], env=env, stdin=document, stdout=work / 'output.txt')
+
+
+def _bench_summarize(document: Path, work: Path, *, env, url, concurrency, prefetch):
+    # The same stages as `go.sh Summarize`, each its own process, each
+    # seeing everything produced before it.
+    args = _llmerick_args(url=url, concurrency=concurrency, prefetch=prefetch)
+    context = { 'input': document.read_text() }
+
+    elapsed = 0.0
+    peak = 0
+    for stage in SUMMARIZE_STAGES:
+        (work / f'{stage}.in.json').write_text(json.dumps(context))
+        if stage == 'execute':
+            code = ['--code-str', EXECUTE_CODE]
+        else:
+            code = ['--code', str(ROOT / 'summarize' / f'{stage}.jsonnet')]
+
+        stage_elapsed, stage_peak = _run([*args, *code], env=env, stdin=work / f'{stage}.in.json', stdout=work / f'{stage}.json')
+        elapsed += stage_elapsed
+        peak = max(peak, stage_peak)
+
+        # postprocess prints the summary itself rather than JSON.
+        try:
+            output = json.loads((work / f'{stage}.json').read_text())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(output, dict):
+            context.update(output)
+
+    return elapsed, peak
+
+
+def _bench_summarize_paragraphs(document: Path, work: Path, *, env, url, concurrency, prefetch):
+    # Run through VisualLLMerick.llmerick(), as the GUI would, but in its own
+    # process so that its peak memory can be measured.
+    args = [
+        sys.executable, '-c', VISUAL_CODE,
+        str(ROOT), str(ROOT / 'stdlib.llmerick'), str(ROOT / 'templates' / 'summarize-paragraphs.llmerick'),
+        url, MODEL, str(concurrency), 'prefetch' if prefetch else 'serial',
+    ]
+    return _run(args, env=env, stdin=document, stdout=work / 'output.txt')
+
+
+TEMPLATES = {
+    'rate-story-coherence': _bench_rate_story_coherence,
+    'summarize': _bench_summarize,
+    'summarize-paragraphs': _bench_summarize_paragraphs,
+}
+
+
+def bench_templates(*, templates: List[str], sizes: List[float], latency: float, error_rate: float, rpm: Optional[int], concurrency: int, prefetch: bool):
+    with tempfile.TemporaryDirectory() as temp, MockServer(latency=latency, error_rate=error_rate, rpm=rpm) as server:
+        temp = Path(temp)
+
+        # The scripts read an API key at startup; the mock server ignores it.
+        env = { **os.environ, 'HOME': str(temp) }
+        (temp / '.openai_api_key').write_text('mock')
+
+        for size in sizes:
+            document = temp / f'document-{size}.txt'
+            document.write_text(synthetic_document(int(size * 2**10)))
+
+            for name in templates:
+                work = temp / f'{name}-{size}'
+                work.mkdir()
+
+                requests, errors = server.requests, server.errors
+                elapsed, peak = TEMPLATES[name](document, work, env=env, url=server.url, concurrency=concurrency, prefetch=prefetch)
+                requests, errors = server.requests - requests, server.errors - errors
+
+                print(f'{name}: size = {size:0.0f}KB; wall = {elapsed:0.2f}s; requests = {requests}; errors = {errors}; rate = {requests / elapsed:0.1f}/s; peak = {peak / 2**10:0.0f}MB')
+
+
+def cli():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('split')
+    subparser.set_defaults(func=bench_split)
+    subparser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16], help='megabytes')
+    subparser.add_argument('--new-tokens', dest='new_tokens', type=int, default=512)
+    subparser.add_argument('--old-tokens', dest='old_tokens', type=int, default=128)
+    subparser.add_argument('--repeat', type=int, default=3)
+
+    subparser = subparsers.add_parser('templates')
+    subparser.set_defaults(func=bench_templates)
+    subparser.add_argument('--templates', nargs='+', choices=list(TEMPLATES), default=list(TEMPLATES))
+    subparser.add_argument('--sizes', type=float, nargs='+', default=[1, 2, 4], help='kilobytes')
+    subparser.add_argument('--latency', type=float, default=0.1, help='seconds')
+    subparser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0)
+    subparser.add_argument('--rpm', type=int, default=None)
+    subparser.add_argument('--concurrency', '-j', type=int, default=8)
+    subparser.add_argument('--prefetch', action='store_true')
+
+    subparser = subparsers.add_parser('helpers')
+    subparser.set_defaults(func=bench_helpers)
+    subparser.add_argument('--helpers', nargs='+', choices=list(HELPER_CASES), default=list(HELPER_CASES))
+    subparser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='elements')
+    subparser.add_argument('--per-key', dest='per_key', type=int, default=4, help='elements sharing each groupBy key')
+    subparser.add_argument('--timeout', type=float, default=120, help='seconds per evaluation')
+
+    subparser = subparsers.add_parser('serve')
+    subparser.set_defaults(func=serve)
+    subparser.add_argument('--port', type=int, default=8000)
+    subparser.add_argument('--latency', type=float, default=0.1, help='seconds')
+    subparser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0)
+    subparser.add_argument('--rpm', type=int, default=None)
+
+    args = vars(parser.parse_args())
+    del args['command']
+
+    func = args.pop('func')
+    func(**args)
+
+
+if __name__ == '__main__':
+    cli()
@@ -6,50 +6,92 @@
 from __future__ import annotations
 from pathlib import Path
 import json
-
-import tiktoken
+import math
+import sys
 
 
 #--- Config
 
+ROOT = Path(__file__).resolve().parent.parent
 MODEL = 'gpt-3.5-turbo'
-PRICING = 0.002 / 1000  # dollars/token
+PERCENTILES = [50, 90, 99]
+
+sys.path.insert(0, str(ROOT))
+from llmerick import count_tokens, expand, price
 
 
 def print_requests_cost(context):
-    encoding = tiktoken.encoding_for_model(MODEL)
-    encode = encoding.encode
+    message_tokens = iter(count_tokens([
+        message['content']
+        for request in context['requests']
+        for message in request['messages']
+    ], model=MODEL))
 
     total_tokens = 0
     for i, request in enumerate(context['requests'], 1):
         request_tokens = 0
         for message in request['messages']:
-            message_tokens = len(encode(message['content']))
-
-            request_tokens += message_tokens
+            request_tokens += next(message_tokens)
         
-        # print(f'  Request {i}: {request_tokens} (${PRICING*request_tokens:0.03f})')
+        # print(f'  Request {i}: {request_tokens} (${price(MODEL, prompt_tokens=request_tokens):0.03f})')
 
         total_tokens += request_tokens
 
-    print(f'Total Requests Cost: # = {i}, {total_tokens} tokens (${PRICING*total_tokens:0.03f})')
+    print(f'Total Requests Cost: # = {i}, {total_tokens} tokens (${price(MODEL, prompt_tokens=total_tokens):0.03f})')
 
 
 def print_responses_cost(context):
-    encoding = tiktoken.encoding_for_model(MODEL)
-    encode = encoding.encode
-
     total_tokens = 0
+    total_cost = 0
     for i, response in enumerate(context['responses'], 1):
         response_tokens = response['usage']['total_tokens']
 
         total_tokens += response_tokens
+        total_cost += price(
+            response.get('model', MODEL),
+            prompt_tokens=response['usage']['prompt_tokens'],
+            completion_tokens=response['usage']['completion_tokens'],
+        )
+
+    print(f'Total Responses Cost: # = {i}, {total_tokens} tokens (${total_cost:0.03f})')
+
+
+def percentile(values, p):
+    # Nearest rank, on values that are already sorted.
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def print_trace_summary(events):
+    """Summarize a --trace file by model and by stage."""
+    groups = {}
+    for event in events:
+        groups.setdefault(('model', event['model']), []).append(event)
+        groups.setdefault(('stage', event['stage'] or '-'), []).append(event)
+
+    for (kind, name), events in sorted(groups.items()):
+        latencies = sorted(event['latency'] for event in events if not event['cached'])
+        cached = sum(event['cached'] for event in events)
+        prompt_tokens = sum(event['prompt_tokens'] for event in events)
+        completion_tokens = sum(event['completion_tokens'] for event in events)
+        retries = sum(event['retries'] for event in events)
+        cost = sum(event['cost'] for event in events)
+
+        print(f'{kind.capitalize()} {name}: # = {len(events)} ({cached} cached), {prompt_tokens} + {completion_tokens} tokens (${cost:0.03f}), {retries} retries')
+        print(f'  Latency: ' + ', '.join(f'p{p} = {percentile(latencies, p):0.3f}s' for p in PERCENTILES) + f', total = {sum(latencies):0.3f}s')
 
-    print(f'Total Responses Cost: # = {i}, {total_tokens} tokens (${PRICING*total_tokens:0.03f})')
 
+def main(reader, writer, trace):
+    if trace:
+        print_trace_summary(
+            json.loads(line)
+            for line in reader
+            if line.strip()
+        )
+        return
 
-def main(reader, writer):
-    context = json.load(reader)
+    context = expand(json.load(reader))
 
     print_requests_cost(context)
     print_responses_cost(context)
@@ -61,6 +103,7 @@ def cli():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', '-i', dest='reader', type=argparse.FileType('rt'), default=sys.stdin)
     parser.add_argument('--output', '-o', dest='writer', type=argparse.FileType('wt'), default=sys.stdout)
+    parser.add_argument('--trace', action='store_true', help='summarize a llmerick --trace file instead')
     args = vars(parser.parse_args())
 
     main(**args)